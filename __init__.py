@@ -1,2 +1,12 @@
 from .transformations import transform
+from .transformations.pipeline import Pipeline
 from .qbids import QuickBIDS
+from .index import DatasetIndex
+from .entities import EntityTable
+from .volume_cache import VolumeCache
+from .patches import PatchQueue
+from .prefetch import DevicePrefetcher, ReadAhead
+from .shared_cache import SharedVolumeCache
+from .batching import BucketBatchSampler, pad_collate
+from .sharding import ShardSampler
+from .profiling import StageProfiler
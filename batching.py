@@ -0,0 +1,167 @@
+import numpy as np
+import torch as T
+from collections import defaultdict as dd
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import Sampler
+
+
+def volume_shapes(dataset, num_threads: int = 8) -> list:
+    '''
+    Returns the shape of every image of a dataset, read from the headers (the data is not loaded). Headers are read
+    concurrently, which matters on network filesystems.
+    Parameters
+    ----------
+    dataset : QuickBIDS
+        Dataset providing volume_shape(idx).
+    num_threads : int
+        Optional. Number of threads reading headers.
+    Returns
+    -------
+    list
+        Shape (tuple) of each image, in dataset order.
+    '''
+    if(num_threads is None or num_threads <= 1):
+        return [dataset.volume_shape(i) for i in range(len(dataset))]
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        return list(pool.map(dataset.volume_shape, range(len(dataset))))
+
+
+class BucketBatchSampler(Sampler):
+    def __init__(self, dataset,
+                 batch_size: int = None,
+                 max_voxels: int = None,
+                 granularity: int = None,
+                 shuffle: bool = True,
+                 drop_last: bool = False,
+                 seed: int = None,
+                 shapes: list = None,
+                 num_threads: int = 8):
+        '''
+        Batch sampler grouping images of the same (or similar) shape, so that batches of mixed-resolution datasets need
+        little or no padding. Use as DataLoader(dataset, batch_sampler=..., collate_fn=pad_collate).
+        Parameters
+        ----------
+        dataset : QuickBIDS
+            Dataset to sample from. Shapes are read from the image headers (see volume_shapes) unless shapes is given.
+        batch_size : int
+            Optional. Maximum number of images per batch. At least one of batch_size and max_voxels must be defined.
+        max_voxels : int
+            Optional. Maximum number of voxels per batch, after padding (e.g. to bound GPU memory). A batch always holds
+            at least one image.
+        granularity : int
+            Optional. If defined, shapes are rounded up to a multiple of granularity to form buckets, so that images
+            of nearly the same shape share a bucket (and are padded by less than granularity voxels per axis).
+            Defaults to exact shapes.
+        shuffle : bool
+            Optional. Whether to shuffle images within buckets and the order of the batches.
+        drop_last : bool
+            Optional. Whether to drop the last, incomplete batch of each bucket.
+        seed : int
+            Optional. Seed of the shuffling; call set_epoch() at the start of every epoch to reshuffle. Without a seed,
+            batches are reshuffled every time the sampler is iterated.
+        shapes : list
+            Optional. Precomputed image shapes, in dataset order (e.g. saved from a previous run of volume_shapes).
+        num_threads : int
+            Optional. Number of threads reading headers.
+        '''
+        if(batch_size is None and max_voxels is None):
+            raise ValueError('Either batch_size or max_voxels must be defined.')
+        if(shapes is None):
+            shapes = volume_shapes(dataset, num_threads=num_threads)
+        if(len(shapes) != len(dataset)):
+            raise ValueError(f'Got {len(shapes)} shapes for a dataset of {len(dataset)} images')
+        self.batch_size = batch_size
+        self.max_voxels = max_voxels
+        self.granularity = granularity
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self.shapes = [tuple(s) for s in shapes]
+
+        self.buckets = dd(list)
+        for i, shape in enumerate(self.shapes):
+            self.buckets[self._bucket_key(shape)].append(i)
+
+    def set_epoch(self, epoch: int):
+        '''
+        Sets the epoch, so that seeded batches are reshuffled every epoch.
+        '''
+        self.epoch = epoch
+
+    def _bucket_key(self, shape: tuple) -> tuple:
+        if(self.granularity is None):
+            return shape
+        g = self.granularity
+        return tuple(-(-n // g) * g for n in shape)
+
+    def _capacity(self, key: tuple) -> int:
+        '''
+        Returns the maximum number of images per batch in the bucket key.
+        '''
+        capacity = self.batch_size if self.batch_size is not None else len(self.shapes)
+        if(self.max_voxels is not None):
+            capacity = min(capacity, max(1, self.max_voxels // max(1, int(np.prod(key)))))
+        return capacity
+
+    def _batches(self, rng: np.random.Generator) -> list:
+        batches = []
+        for key, indices in self.buckets.items():
+            indices = np.asarray(indices)
+            if(rng is not None):
+                indices = rng.permutation(indices)
+            capacity = self._capacity(key)
+            for start in range(0, len(indices), capacity):
+                batch = indices[start:start + capacity]
+                if(len(batch) < capacity and self.drop_last):
+                    continue
+                batches.append(batch.tolist())
+        if(rng is not None):
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        rng = None
+        if(self.shuffle):
+            # Batch samplers are iterated in the main process only, so unseeded shuffling can draw fresh randomness
+            rng = np.random.default_rng() if self.seed is None else np.random.default_rng([self.seed, self.epoch])
+        return iter(self._batches(rng))
+
+    def __len__(self):
+        n = 0
+        for key, indices in self.buckets.items():
+            capacity = self._capacity(key)
+            n += len(indices) // capacity if self.drop_last else -(-len(indices) // capacity)
+        return n
+
+
+def pad_collate(batch: list, pad_value: float = 0):
+    '''
+    Collates images of different shapes by padding them (at the end of each axis) to the largest shape of the batch.
+    Parameters
+    ----------
+    batch : list
+        Samples returned by QuickBIDS: Tensors, or (Tensor, tabular data) tuples.
+    pad_value : float
+        Optional. Value of the padding.
+    Returns
+    -------
+    Tensor
+        Padded images, [batch x max shape].
+    Tensor
+        Boolean mask, same shape as the images; True where the data is not padding.
+    list
+        Only if samples include tabular data: tabular data of each sample.
+    '''
+    has_tabular = isinstance(batch[0], (tuple, list))
+    dats = [b[0] for b in batch] if has_tabular else list(batch)
+    shape = tuple(max(s) for s in zip(*(d.shape for d in dats)))
+    out = T.full((len(dats), *shape), pad_value, dtype=dats[0].dtype, device=dats[0].device)
+    mask = T.zeros((len(dats), *shape), dtype=T.bool, device=dats[0].device)
+    for i, d in enumerate(dats):
+        region = (i, *(slice(0, n) for n in d.shape))
+        out[region] = d
+        mask[region] = True
+    if(has_tabular):
+        return out, mask, [b[1] for b in batch]
+    return out, mask
@@ -0,0 +1,64 @@
+'''
+Compares the serial os.walk crawl of QuickBIDS with the parallel os.scandir crawler on a synthetic tree.
+Run from the directory containing the package, e.g.:
+    python -m neurodataloader.benchmarks.bench_crawl --n_files 100000 --threads 16
+'''
+import argparse
+import os
+import tempfile
+import time
+from ..qbids import QuickBIDS
+
+
+def make_empty_tree(root_dir: str, n_files: int, files_per_session: int = 10, n_sessions: int = 2):
+    '''
+    Creates a BIDS-like tree of empty files: sub-X/ses-Y/anat/ with half images and half .json sidecars, and one .csv
+    per subject.
+    '''
+    n_subjects = max(1, n_files // (files_per_session * n_sessions))
+    for i in range(n_subjects):
+        sub_dir = os.path.join(root_dir, f'sub-{i:06d}')
+        for j in range(n_sessions):
+            ses_dir = os.path.join(sub_dir, f'ses-{j}', 'anat')
+            os.makedirs(ses_dir)
+            for k in range(files_per_session // 2):
+                stem = os.path.join(ses_dir, f'sub-{i:06d}_ses-{j}_run-{k}_T1w')
+                open(stem + '.nii.gz', 'w').close()
+                open(stem + '.json', 'w').close()
+        with open(os.path.join(sub_dir, f'sub-{i:06d}.csv'), 'w') as f:
+            f.write('eid,age\n')
+    return n_subjects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n_files', type=int, default=100000, help='Approximate number of files in the tree.')
+    parser.add_argument('--threads', type=int, default=16, help='Threads for the parallel crawl.')
+    parser.add_argument('--root_dir', type=str, default=None,
+                        help='Existing tree to crawl instead of a synthetic one (e.g. on a network filesystem).')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        root_dir = args.root_dir
+        if(root_dir is None):
+            root_dir = os.path.join(tmp_dir, 'bids')
+            start = time.perf_counter()
+            n_subjects = make_empty_tree(root_dir, args.n_files)
+            print(f'Created {n_subjects} subjects in {time.perf_counter() - start:.1f}s')
+
+        for name, kwargs in [('serial os.walk', {}),
+                             (f'parallel scandir ({args.threads} threads)', {'crawl_threads': args.threads})]:
+            start = time.perf_counter()
+            dataset = QuickBIDS(root_dir, tabular_to_fetch=['age'], verbose=False, device='cpu', **kwargs)
+            print(f'{name}: {len(dataset)} images in {time.perf_counter() - start:.2f}s')
+
+        file_of_files = os.path.join(tmp_dir, 'files.txt')
+        with open(file_of_files, 'w') as f:
+            f.write('\n'.join(dataset.file_path_dict[fil] for fil in dataset.file_list))
+        start = time.perf_counter()
+        dataset = QuickBIDS(file_of_files=file_of_files, tabular_to_fetch=['age'], verbose=False, device='cpu')
+        print(f'file_of_files: {len(dataset)} images in {time.perf_counter() - start:.2f}s')
+
+
+if __name__ == '__main__':
+    main()
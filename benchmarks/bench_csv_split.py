@@ -0,0 +1,53 @@
+'''
+Compares the row-by-row and vectorized modes of utilities.csv_split on a synthetic wide table.
+Run from the directory containing the package, e.g.:
+    python -m neurodataloader.benchmarks.bench_csv_split --rows 5000 --cols 2000
+'''
+import argparse
+import os
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from ..utilities import csv_split
+
+
+def make_wide_table(table_file: str, n_rows: int, n_cols: int, seed: int = 0):
+    '''
+    Writes a table with an 'eid' column, a 'visit' column (0 or 1), and n_cols float columns named like UK Biobank
+    fields ('<field>-0.0').
+    '''
+    rng = np.random.default_rng(seed)
+    frame = pd.DataFrame(rng.normal(size=(n_rows, n_cols)).round(4), columns=[f'{i}-0.0' for i in range(n_cols)])
+    frame.insert(0, 'visit', rng.integers(2, size=n_rows))
+    frame.insert(0, 'eid', np.arange(1000000, 1000000 + n_rows))
+    frame.to_csv(table_file, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=5000, help='Number of rows of the synthetic table.')
+    parser.add_argument('--cols', type=int, default=2000, help='Number of columns of the synthetic table.')
+    parser.add_argument('--chunksize', type=int, default=1000, help='Rows loaded at a time.')
+    parser.add_argument('--n_jobs', type=int, default=8, help='Writer threads of the vectorized mode.')
+    parser.add_argument('--skip_rows', action='store_true', help='Skip the (slow) row-by-row mode.')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        table_file = os.path.join(tmp_dir, 'table.csv')
+        start = time.perf_counter()
+        make_wide_table(table_file, args.rows, args.cols)
+        print(f'Created {args.rows} x {args.cols} table in {time.perf_counter() - start:.1f}s')
+
+        modes = [('vectorized', True)] if args.skip_rows else [('row-by-row', False), ('vectorized', True)]
+        for name, vectorized in modes:
+            template = os.path.join(tmp_dir, name, 'sub-{eid}', 'sub-{eid}.csv')
+            start = time.perf_counter()
+            csv_split(table_file, template, chunksize=args.chunksize, include_match={'visit': 1},
+                      vectorized=vectorized, n_jobs=args.n_jobs)
+            elapsed = time.perf_counter() - start
+            print(f'{name}: {elapsed:.2f}s ({args.rows / elapsed:.0f} rows/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+'''
+Benchmark suite for the hot paths of the package: QuickBIDS.__getitem__ (directly and through a DataLoader with
+several worker counts), transform.affine, interp_linear / interp_nearest and utilities.csv_split, on synthetic data
+created locally. Reports samples/s, latency percentiles and peak RSS for every case, and writes them to a JSON file
+so that runs can be compared over time. Loading cases also report p50 / p95 latencies per stage (open, read, convert,
+sample), recorded with profiling.StageProfiler in the main process and the DataLoader workers.
+Run from the directory containing the package, e.g.:
+    python -m neurodataloader.benchmarks.bench_suite --shapes 64x64x64,128x128x128 --workers 0,2,4 --output run.json
+Each case runs in a fresh process (unless --no_isolate), so that its peak RSS is not inflated by earlier cases.
+Peak RSS of DataLoader workers is reported separately ('children').
+'''
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+import torch as T
+from torch.utils.data import DataLoader
+from .bench_csv_split import make_wide_table
+from .synthetic import make_nifti_tree
+from ..qbids import QuickBIDS
+from ..transformations import interpolation, matrices, transform
+from ..utilities import csv_split
+
+BENCHMARKS = ['getitem', 'loader', 'affine', 'interp', 'csv_split']
+
+
+def latency_stats(latencies: list) -> dict:
+    '''
+    Returns latency percentiles (p50, p90, p99), mean and max, in milliseconds.
+    '''
+    ms = np.asarray(latencies) * 1000
+    return {'p50': float(np.percentile(ms, 50)), 'p90': float(np.percentile(ms, 90)),
+            'p99': float(np.percentile(ms, 99)), 'mean': float(ms.mean()), 'max': float(ms.max())}
+
+
+def stage_stats(profiler) -> dict:
+    '''
+    Returns the count, mean, p50 and p95 (in milliseconds) of every stage recorded by a profiling.StageProfiler, and
+    closes it.
+    '''
+    summary = profiler.summary()
+    profiler.close()
+    return {name: {'count': s['count'], 'mean': s['mean_ms'], 'p50': s['p50_ms'], 'p95': s['p95_ms']}
+            for name, s in summary.items()}
+
+
+def peak_rss_mb() -> dict:
+    '''
+    Returns the peak resident set size of this process ('self') and of its largest terminated child, e.g. a DataLoader
+    worker ('children'), in MB.
+    '''
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    peak = {'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20,
+            'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale / 2 ** 20}
+    # On Linux, ru_maxrss carries over from the parent through fork and exec; the high-water mark does not
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if(line.startswith('VmHWM:')):
+                    peak['self'] = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return peak
+
+
+def _time_calls(fn, repeats: int, warmup: int = 1) -> list:
+    for _ in range(warmup):
+        fn()
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def bench_getitem(root_dir: str, repeats: int, **kwargs) -> dict:
+    '''
+    Loads every image of the dataset, repeats times, with QuickBIDS.__getitem__ in the main process.
+    '''
+    dataset = QuickBIDS(root_dir, verbose=False, device=None, profile=True, **kwargs)
+    latencies = []
+    for _ in range(repeats):
+        for i in range(len(dataset)):
+            start = time.perf_counter()
+            dataset[i]
+            latencies.append(time.perf_counter() - start)
+    return {'samples_per_sec': len(latencies) / sum(latencies), 'latency_ms': latency_stats(latencies),
+            'stages_ms': stage_stats(dataset.profiler)}
+
+
+def bench_loader(root_dir: str, num_workers: int, batch_size: int, repeats: int, **kwargs) -> dict:
+    '''
+    Iterates over the dataset through a DataLoader, repeats times; latencies are per batch. Stage latencies include the
+    first epoch (worker startup is not part of any stage).
+    '''
+    dataset = QuickBIDS(root_dir, verbose=False, device=None, profile=True, **kwargs)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                        persistent_workers=num_workers > 0)
+    # The first epoch starts the workers; it is timed separately
+    start = time.perf_counter()
+    for _ in loader:
+        pass
+    startup = time.perf_counter() - start
+    latencies = []
+    n_samples = 0
+    total_start = time.perf_counter()
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for batch in loader:
+            latencies.append(time.perf_counter() - start)
+            n_samples += len(batch[0] if isinstance(batch, (list, tuple)) else batch)
+            start = time.perf_counter()
+    total = time.perf_counter() - total_start
+    # Stop the workers, so that their peak RSS is accounted for and their stage timings are published
+    del loader
+    return {'samples_per_sec': n_samples / total, 'latency_ms': latency_stats(latencies), 'first_epoch_s': startup,
+            'stages_ms': stage_stats(dataset.profiler)}
+
+
+def bench_affine(shape: tuple, interpolation_mode: str, repeats: int) -> dict:
+    '''
+    Applies transform.affine with a random matrix to a volume.
+    '''
+    dat = T.rand(shape)
+    mat = matrices.random_affine_3d(translation_limits=T.tensor([[-5., 5.]] * 3),
+                                    rotation_limits=T.tensor([[-0.2, 0.2]] * 3),
+                                    scale_limits=T.tensor([[0.9, 1.1]] * 3))
+    latencies = _time_calls(lambda: transform.affine(dat, mat, interpolation=interpolation_mode), repeats)
+    return {'samples_per_sec': len(latencies) / sum(latencies), 'latency_ms': latency_stats(latencies),
+            'voxels_per_sec': dat.numel() * len(latencies) / sum(latencies)}
+
+
+def bench_interp(shape: tuple, kind: str, repeats: int) -> dict:
+    '''
+    Samples a volume at jittered voxel locations with interp_linear or interp_nearest.
+    '''
+    dat = T.rand(shape)
+    grid = T.stack([T.arange(n, dtype=T.float32).view([-1 if i == d else 1 for i in range(len(shape))]).expand(shape)
+                    for d, n in enumerate(shape)])
+    locations = grid + T.rand(grid.shape) - 0.5
+    fn = interpolation.interp_linear if kind == 'linear' else interpolation.interp_nearest
+    latencies = _time_calls(lambda: fn(dat, locations), repeats)
+    return {'samples_per_sec': len(latencies) / sum(latencies), 'latency_ms': latency_stats(latencies),
+            'voxels_per_sec': dat.numel() * len(latencies) / sum(latencies)}
+
+
+def bench_csv_split(tmp_dir: str, n_rows: int, n_cols: int, vectorized: bool) -> dict:
+    '''
+    Splits a synthetic wide table into one file per row.
+    '''
+    table_file = os.path.join(tmp_dir, f'table_{n_rows}x{n_cols}.csv')
+    if(not os.path.isfile(table_file)):
+        make_wide_table(table_file, n_rows, n_cols)
+    out_dir = tempfile.mkdtemp(dir=tmp_dir)
+    start = time.perf_counter()
+    csv_split(table_file, os.path.join(out_dir, 'sub-{eid}', 'sub-{eid}.csv'), vectorized=vectorized)
+    elapsed = time.perf_counter() - start
+    return {'samples_per_sec': n_rows / elapsed, 'seconds': elapsed}
+
+
+def _run_case(fn, kwargs: dict, queue):
+    try:
+        result = fn(**kwargs)
+        result['peak_rss_mb'] = peak_rss_mb()
+        queue.put(result)
+    except Exception as e:
+        queue.put({'error': repr(e)})
+
+
+def run_case(fn, kwargs: dict, isolate: bool = True) -> dict:
+    '''
+    Runs a benchmark function, in a fresh process if isolate is True, and adds its peak RSS to the result.
+    '''
+    if(not isolate):
+        result = fn(**kwargs)
+        result['peak_rss_mb'] = peak_rss_mb()
+        return result
+    ctx = mp.get_context('spawn')
+    queue = ctx.Queue()
+    # Not a daemon, so that it can start DataLoader workers
+    proc = ctx.Process(target=_run_case, args=(fn, kwargs, queue), daemon=False)
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def _parse_shapes(text: str) -> list:
+    return [tuple(int(n) for n in s.split('x')) for s in text.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--benchmarks', type=str, default=','.join(BENCHMARKS),
+                        help=f'Comma-separated benchmarks to run, among {BENCHMARKS}.')
+    parser.add_argument('--shapes', type=str, default='64x64x64,128x128x128', help='Volume shapes, e.g. 64x64x64.')
+    parser.add_argument('--workers', type=str, default='0,2,4', help='DataLoader worker counts.')
+    parser.add_argument('--n_subjects', type=int, default=16, help='Subjects in the synthetic trees.')
+    parser.add_argument('--batch_size', type=int, default=4, help='DataLoader batch size.')
+    parser.add_argument('--repeats', type=int, default=5, help='Repetitions (epochs, or calls) per case.')
+    parser.add_argument('--csv_rows', type=int, default=2000, help='Rows of the synthetic table.')
+    parser.add_argument('--csv_cols', type=int, default=500, help='Columns of the synthetic table.')
+    parser.add_argument('--uncompressed', action='store_true', help='Write .nii instead of .nii.gz files.')
+    parser.add_argument('--no_isolate', action='store_true', help='Run every case in this process.')
+    parser.add_argument('--output', type=str, default=None, help='JSON file in which to write the results.')
+    args = parser.parse_args()
+
+    benchmarks = args.benchmarks.split(',')
+    shapes = _parse_shapes(args.shapes)
+    workers = [int(w) for w in args.workers.split(',')]
+    isolate = not args.no_isolate
+    results = []
+
+    def record(name: str, params: dict, fn, kwargs: dict):
+        result = run_case(fn, kwargs, isolate=isolate)
+        results.append({'benchmark': name, 'params': params, **result})
+        if('error' in result):
+            print(f'{name} {params}: {result["error"]}')
+        else:
+            print(f'{name} {params}: {result["samples_per_sec"]:.1f} samples/s, '
+                  f'p50 {result["latency_ms"]["p50"] if "latency_ms" in result else float("nan"):.2f} ms, '
+                  f'peak RSS {result["peak_rss_mb"]["self"]:.0f} MB')
+            for stage in ['sample', 'open', 'read', 'convert']:
+                if(stage in result.get('stages_ms', {})):
+                    s = result['stages_ms'][stage]
+                    print(f'    {stage:<8} p50 {s["p50"]:.2f} ms, p95 {s["p95"]:.2f} ms')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for shape in shapes:
+            shape_name = 'x'.join(str(n) for n in shape)
+            if('getitem' in benchmarks or 'loader' in benchmarks):
+                root_dir = os.path.join(tmp_dir, f'bids_{shape_name}')
+                make_nifti_tree(root_dir, args.n_subjects, shape=shape, compressed=not args.uncompressed)
+            if('getitem' in benchmarks):
+                for memmap in [False, True]:
+                    record('getitem', {'shape': shape, 'memmap': memmap}, bench_getitem,
+                           {'root_dir': root_dir, 'repeats': args.repeats, 'memmap': memmap})
+            if('loader' in benchmarks):
+                for num_workers in workers:
+                    record('loader', {'shape': shape, 'num_workers': num_workers}, bench_loader,
+                           {'root_dir': root_dir, 'num_workers': num_workers, 'batch_size': args.batch_size,
+                            'repeats': args.repeats})
+            if('affine' in benchmarks):
+                for mode in ['nearest', 'linear']:
+                    record('affine', {'shape': shape, 'interpolation': mode}, bench_affine,
+                           {'shape': shape, 'interpolation_mode': mode, 'repeats': args.repeats})
+            if('interp' in benchmarks):
+                for kind in ['nearest', 'linear']:
+                    record('interp', {'shape': shape, 'kind': kind}, bench_interp,
+                           {'shape': shape, 'kind': kind, 'repeats': args.repeats})
+        if('csv_split' in benchmarks):
+            for vectorized in [False, True]:
+                record('csv_split', {'rows': args.csv_rows, 'cols': args.csv_cols, 'vectorized': vectorized},
+                       bench_csv_split, {'tmp_dir': tmp_dir, 'n_rows': args.csv_rows, 'n_cols': args.csv_cols,
+                                         'vectorized': vectorized})
+
+    if(args.output is not None):
+        meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                'torch': T.__version__, 'numpy': np.__version__, 'platform': platform.platform(),
+                'cpu_count': os.cpu_count(), 'args': vars(args)}
+        with open(args.output, 'w') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+        print(f'Results written to {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+'''
+Synthetic BIDS-like datasets for the benchmarks.
+'''
+import os
+import numpy as np
+import nibabel as nb
+
+
+def make_nifti_tree(root_dir: str, n_subjects: int, shape: tuple = (64, 64, 64), n_sessions: int = 1,
+                    suffixes: tuple = ('T1w',), compressed: bool = True, dtype=np.int16, seed: int = 0) -> list:
+    '''
+    Creates a tree of random NIfTI images, sub-X/ses-Y/anat/sub-X_ses-Y_<suffix>.nii[.gz], with one .csv (eid, age,
+    sex) per subject.
+    Parameters
+    ----------
+    root_dir : str
+        Directory in which to create the tree.
+    n_subjects : int
+        Number of subjects.
+    shape : tuple
+        Optional. Shape of the images.
+    n_sessions : int
+        Optional. Number of sessions per subject.
+    suffixes : tuple
+        Optional. One image per suffix in every session.
+    compressed : bool
+        Optional. Whether to write .nii.gz (True) or .nii files.
+    dtype
+        Optional. On-disk data type of the images.
+    seed : int
+        Optional. Seed of the image data.
+    Returns
+    -------
+    list
+        Paths of the images.
+    '''
+    rng = np.random.default_rng(seed)
+    ext = '.nii.gz' if compressed else '.nii'
+    # Every image is the same i.i.d. noise base plus its own low 3 bits. Noise compresses far worse than real images,
+    # so decompression times are on the pessimistic side
+    base = rng.integers(0, 1000, size=shape).astype(dtype)
+    paths = []
+    for i in range(n_subjects):
+        sub = f'{i:04d}'
+        sub_dir = os.path.join(root_dir, f'sub-{sub}')
+        for j in range(n_sessions):
+            anat_dir = os.path.join(sub_dir, f'ses-{j + 1}', 'anat')
+            os.makedirs(anat_dir, exist_ok=True)
+            for suffix in suffixes:
+                dat = (base // 8 * 8 + rng.integers(0, 8, size=shape)).astype(dtype)
+                path = os.path.join(anat_dir, f'sub-{sub}_ses-{j + 1}_{suffix}{ext}')
+                nb.save(nb.Nifti1Image(dat, np.eye(4)), path)
+                paths.append(path)
+        with open(os.path.join(sub_dir, f'sub-{sub}.csv'), 'w') as f:
+            f.write(f'eid,age,sex\n{sub},{rng.integers(40, 80)},{rng.integers(2)}\n')
+    return paths
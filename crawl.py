@@ -0,0 +1,136 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from .entities import entity_splitter, is_image
+
+
+def crawl(root_dir: str, num_threads: int = 8, find_tabular: bool = True, top_dirs: list = None) -> list:
+    '''
+    Lists all images below root_dir. Top-level directories (typically subject directories) are walked concurrently in a
+    thread pool with os.scandir, which hides per-directory latency on network filesystems.
+    Parameters
+    ----------
+    root_dir : str
+        Root directory of the BIDS data.
+    num_threads : int
+        Optional. Number of directories listed concurrently.
+    find_tabular : bool
+        Optional. Whether to resolve the tabular (.csv) file of each image's subject directory. Each subject directory is
+        resolved once, from the listing made during the crawl.
+    top_dirs : list
+        Optional. If defined, only these top-level directories (names relative to root_dir) are walked, and images
+        directly in root_dir are skipped; e.g. the subject directories of one shard. Root_dir itself is not listed.
+    Returns
+    -------
+    list
+        List of (name, path, entities, tabular_path) for every image, in sorted directory order. tabular_path is None
+        if find_tabular is False or the subject has no .csv.
+    '''
+    if(top_dirs is None):
+        root_files, root_dirs = _scan(root_dir)
+    else:
+        root_files, root_dirs = [], sorted(top_dirs)
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        subtrees = list(pool.map(_walk_subtree, [os.path.join(root_dir, d) for d in root_dirs]))
+
+    images = [(root_dir, f) for f in root_files if is_image(f)]
+    tabular_dict = {}
+    for sub_images, sub_tabular in subtrees:
+        images.extend(sub_images)
+        tabular_dict.update(sub_tabular)
+
+    file_list = []
+    for dirpath, f in images:
+        ent_dict = entity_splitter(f)
+        tabular_path = None
+        if(find_tabular):
+            tabular_path = tabular_dict.get(_subject_dir(dirpath, ent_dict['sub']))
+        file_list.append((f, os.path.join(dirpath, f), ent_dict, tabular_path))
+    return file_list
+
+
+def _scan(dirpath: str):
+    '''
+    Returns the sorted file names and subdirectory names of dirpath.
+    '''
+    files = []
+    subdirs = []
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            if(entry.is_dir()):
+                subdirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    files.sort()
+    subdirs.sort()
+    return files, subdirs
+
+
+def _walk_subtree(top: str):
+    '''
+    Walks a directory tree serially.
+    Returns
+    -------
+    list
+        (dirpath, name) of every image in the tree.
+    dict
+        Mapping of subject directory ("sub-*") to its first .csv file.
+    '''
+    images = []
+    tabular_dict = {}
+    stack = [top]
+    while stack:
+        dirpath = stack.pop()
+        files, subdirs = _scan(dirpath)
+        if(os.path.basename(dirpath).startswith('sub-')):
+            # Assumes that only one .csv is present
+            csvs = [f for f in files if f.endswith('.csv')]
+            if(len(csvs) > 0):
+                tabular_dict[dirpath] = os.path.join(dirpath, csvs[0])
+        images.extend((dirpath, f) for f in files if is_image(f))
+        stack.extend(os.path.join(dirpath, s) for s in reversed(subdirs))
+    return images, tabular_dict
+
+
+def _subject_dir(dirpath: str, sub_name: str) -> str:
+    '''
+    Returns the "sub-<sub_name>" directory containing dirpath.
+    '''
+    sub_dir = dirpath.split('sub-' + sub_name)[0]
+    return os.path.join(sub_dir, f'sub-{sub_name}')
+
+
+def parse_file_list(files: list, find_tabular: bool = True) -> list:
+    '''
+    Parses a list of image paths in bulk. Entities are parsed from the file names (not the full paths), and the
+    tabular file of each subject directory is looked up once per subject rather than once per image.
+    Parameters
+    ----------
+    files : list
+        List of paths. Entries that are not images are skipped.
+    find_tabular : bool
+        Optional. Whether to resolve the tabular (.csv) file of each image's subject directory.
+    Returns
+    -------
+    list
+        List of (name, path, entities, tabular_path); see crawl.
+    '''
+    file_list = []
+    tabular_dict = {}
+    for fil in files:
+        if(not is_image(fil)):
+            continue
+        name = os.path.basename(fil)
+        ent_dict = entity_splitter(name)
+        tabular_path = None
+        if(find_tabular):
+            sub_dir = _subject_dir(os.path.dirname(fil), ent_dict['sub'])
+            if(sub_dir not in tabular_dict):
+                tabular_dict[sub_dir] = None
+                if(os.path.isdir(sub_dir)):
+                    for s in sorted(os.listdir(sub_dir)):
+                        if(s.endswith('.csv')):
+                            tabular_dict[sub_dir] = os.path.join(sub_dir, s)
+                            break
+            tabular_path = tabular_dict[sub_dir]
+        file_list.append((name, fil, ent_dict, tabular_path))
+    return file_list
@@ -0,0 +1,188 @@
+import re
+import numpy as np
+import pandas as pd
+from collections import defaultdict as dd
+
+
+def entity_splitter(filename: str,
+                    entity_delim: str = '_',
+                    keyval_delim: str = '-') -> dict:
+    '''
+    Splits the input BIDS-compliant filename into its separate entities.
+    Parameters
+    ----------
+    filename : str
+        Filename to split
+    entity_delim : str
+        Delimiter between entities.  (in "sub-1234_ses-2", the underscore "_" is the entity delim)
+    keyval_delim : str
+        Delimiter between key-value pairs. (in "sub-1234_ses-2", the dash "-" is the keyval delim)
+    Returns
+    -------
+    dict
+        Dictionary with the found entities, and 'suffix' for the last entity (if unkeyed)
+    '''
+    spl = filename.split(entity_delim)
+    entity_dict = dd(str)
+    for ind, s in enumerate(spl):
+        if(keyval_delim in s):
+            k, v = s.split(keyval_delim)
+            entity_dict[k] = v
+        elif(ind == len(spl)-1):
+            entity_dict['suffix'] = s.split('.')[0]
+            entity_dict['extension'] = '.'.join(s.split('.')[1:])
+    return entity_dict
+
+
+def is_image(filename: str) -> bool:
+    '''
+    Returns whether filename is a NIfTI image (.nii or .nii.gz).
+    '''
+    return filename.endswith('.nii.gz') or filename.endswith('.nii')
+
+
+class EntityTable:
+    def __init__(self, entity_dicts: list = None, frame: pd.DataFrame = None):
+        '''
+        Columnar table of parsed entities, with one row per file and one categorical column per entity. Missing
+        entities are stored as ''.
+        Parameters
+        ----------
+        entity_dicts : list
+            List of entity dictionaries, as returned by entity_splitter.
+        frame : pd.DataFrame
+            Optional. Already-built table; used instead of entity_dicts.
+        '''
+        if(frame is None):
+            frame = pd.DataFrame.from_records(entity_dicts if entity_dicts is not None else [])
+            frame = frame.fillna('').astype(str).astype('category')
+        self.frame = frame.reset_index(drop=True)
+
+    def __len__(self):
+        return len(self.frame)
+
+    @property
+    def columns(self) -> list:
+        return list(self.frame.columns)
+
+    def mask(self, conditions: dict) -> np.ndarray:
+        '''
+        Evaluates the conjunction (AND) of conditions on every row.
+        Parameters
+        ----------
+        conditions : dict
+            Mapping of entity name to condition. A condition can be:
+            - a str (or number): exact match, e.g. {'sub': '1234'}
+            - a list, tuple or set: match any of the values, e.g. {'ses': ['1', '2']}
+            - a slice: numeric range, start included and stop excluded, either bound may be None,
+              e.g. {'run': slice(1, 3)}. Non-numeric values never match.
+            - a compiled regular expression: must match the whole value, e.g. {'suffix': re.compile('T[12]w')}
+        Returns
+        -------
+        np.ndarray
+            Boolean array of length len(self).
+        '''
+        mask = np.ones(len(self), dtype=bool)
+        for ent_name, cond in conditions.items():
+            if(ent_name not in self.frame.columns):
+                # Entity absent from every file; only an empty-string match could succeed
+                col_match = self._match_values(np.array(['']), cond)[0]
+                if(not col_match):
+                    mask[:] = False
+                continue
+            col = self.frame[ent_name].cat
+            # Evaluate the condition once per category, then broadcast through the codes
+            lut = np.zeros(len(col.categories) + 1, dtype=bool)
+            lut[:-1] = self._match_values(np.asarray(col.categories, dtype=str), cond)
+            mask &= lut[col.codes.to_numpy()]
+        return mask
+
+    @staticmethod
+    def _match_values(values: np.ndarray, cond) -> np.ndarray:
+        '''
+        Evaluates a single condition (see mask) on an array of str values.
+        '''
+        if(isinstance(cond, re.Pattern)):
+            return np.array([cond.fullmatch(v) is not None for v in values], dtype=bool)
+        if(isinstance(cond, slice)):
+            if(cond.step is not None):
+                raise ValueError('Range conditions do not support a step')
+            num = pd.to_numeric(pd.Series(values), errors='coerce').to_numpy(dtype=float)
+            match = ~np.isnan(num)
+            if(cond.start is not None):
+                match &= num >= cond.start
+            if(cond.stop is not None):
+                match &= num < cond.stop
+            return match
+        if(isinstance(cond, (list, tuple, set, frozenset))):
+            return np.isin(values, [str(c) for c in cond])
+        return values == str(cond)
+
+    def query(self, conditions) -> np.ndarray:
+        '''
+        Returns the indices of rows that match the conditions.
+        Parameters
+        ----------
+        conditions : dict or list
+            Either a dict of conditions, all of which must hold (AND; see mask), or a list of such dicts, any of which
+            must hold (OR). E.g. [{'sub': '01', 'suffix': 'T1w'}, {'suffix': 'FLAIR'}]
+        Returns
+        -------
+        np.ndarray
+            Sorted array of row indices.
+        '''
+        if(isinstance(conditions, dict)):
+            mask = self.mask(conditions)
+        else:
+            mask = np.zeros(len(self), dtype=bool)
+            for c in conditions:
+                mask |= self.mask(c)
+        return np.flatnonzero(mask)
+
+    def take(self, indices) -> 'EntityTable':
+        '''
+        Returns a new EntityTable with the rows at indices.
+        '''
+        return EntityTable(frame=self.frame.iloc[np.asarray(indices)])
+
+    def groups(self, keys: list, members: list = None, member_entity: str = 'suffix') -> list:
+        '''
+        Joins rows that have the same values of keys (e.g. the images of one session) into groups.
+        Parameters
+        ----------
+        keys : list
+            Entities to join on, e.g. ['sub', 'ses', 'run']. Entities absent from a file count as ''.
+        members : list
+            Optional. Values of member_entity making up a group, in order, e.g. ['T1w', 'T2w', 'FLAIR', 'dseg']. Rows
+            with other values are ignored. Defaults to every value of member_entity, sorted.
+        member_entity : str
+            Optional. Entity telling the members of a group apart.
+        Returns
+        -------
+        list
+            One tuple of row indices per group that has all members, in the order of members. Groups are in the order
+            of their first row.
+        '''
+        def column(name: str) -> np.ndarray:
+            if(name in self.frame.columns):
+                return self.frame[name].astype(str).to_numpy()
+            return np.full(len(self), '', dtype=object)
+
+        member_values = column(member_entity)
+        if(members is None):
+            members = sorted(set(member_values))
+        position = {m: i for i, m in enumerate(members)}
+        groups = {}
+        row_keys = zip(*[column(k) for k in keys]) if len(keys) > 0 else [()] * len(self)
+        for row, key in enumerate(row_keys):
+            pos = position.get(member_values[row])
+            if(pos is None):
+                continue
+            group = groups.get(key)
+            if(group is None):
+                group = groups[key] = [None] * len(members)
+            if(group[pos] is not None):
+                raise ValueError(f'Rows {group[pos]} and {row} are both {member_entity}={members[pos]} of group '
+                                 f'{dict(zip(keys, key))}; add the entity that tells them apart to the keys')
+            group[pos] = row
+        return [tuple(g) for g in groups.values() if None not in g]
@@ -0,0 +1,235 @@
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from .entities import entity_splitter, is_image
+
+# One selected image in the index.
+IndexEntry = namedtuple('IndexEntry', ['name', 'path', 'size', 'mtime', 'entities', 'tabular_path'])
+
+
+class DatasetIndex:
+    INDEX_VERSION = 1
+
+    def __init__(self, root_dir: str, top_dirs: list = None):
+        '''
+        On-disk index of a BIDS-like directory. Stores, for every directory below root_dir, its mtime, its
+        subdirectories and its files (with size and mtime), the parsed entities of every image, and the tabular
+        (.csv) file of every subject directory.
+        The index is refreshed incrementally: only directories whose mtime has changed since the last scan are listed
+        again. Note that a file rewritten in place does not change the mtime of its directory; use
+        refresh(full=True) to pick up such changes.
+        Parameters
+        ----------
+        root_dir : str
+            Root directory of the BIDS data.
+        top_dirs : list
+            Optional. If defined, only these top-level directories (names relative to root_dir) are indexed, and images
+            directly in root_dir are left out; e.g. the subject directories of one shard.
+        '''
+        self.root_dir = root_dir
+        self.top_dirs = sorted(top_dirs) if top_dirs is not None else None
+        # dirpath -> {'mtime': int, 'subdirs': list, 'files': list of (name, size, mtime), 'entities': dict,
+        #             'tabular': str}
+        self.dirs = {}
+
+    def refresh(self, full: bool = False, num_threads: int = None) -> int:
+        '''
+        Updates the index to reflect the current state of the directory.
+        Parameters
+        ----------
+        full : bool
+            Optional. If True, rescans every directory regardless of its mtime.
+        num_threads : int
+            Optional. If defined, directories at the same depth are checked and listed concurrently by this many threads.
+        Returns
+        -------
+        int
+            Number of directories that were (re)scanned or removed.
+        '''
+        new_dirs = {}
+        n_scanned = 0
+        pool = ThreadPoolExecutor(max_workers=num_threads) if num_threads is not None else None
+        try:
+            # Breadth-first, one level at a time; directories keep their sorted order within each level
+            level = [self.root_dir]
+            while level:
+                if(pool is None):
+                    results = [self._refresh_dir(d, full) for d in level]
+                else:
+                    results = list(pool.map(lambda d: self._refresh_dir(d, full), level))
+                next_level = []
+                for dirpath, (record, scanned) in zip(level, results):
+                    if(record is None):
+                        continue
+                    n_scanned += scanned
+                    new_dirs[dirpath] = record
+                    subdirs = record['subdirs']
+                    if(dirpath == self.root_dir and self.top_dirs is not None):
+                        subdirs = [s for s in subdirs if s in set(self.top_dirs)]
+                    next_level.extend(os.path.join(dirpath, s) for s in subdirs)
+                level = next_level
+        finally:
+            if(pool is not None):
+                pool.shutdown()
+        n_scanned += len(self.dirs.keys() - new_dirs.keys())
+        self.dirs = new_dirs
+        return n_scanned
+
+    def _refresh_dir(self, dirpath: str, full: bool):
+        '''
+        Returns the up-to-date record of dirpath (None if it no longer exists), and whether it had to be rescanned.
+        '''
+        try:
+            mtime = os.stat(dirpath).st_mtime_ns
+        except FileNotFoundError:
+            return None, False
+        record = self.dirs.get(dirpath)
+        if(full or record is None or record['mtime'] != mtime):
+            return self._scan_dir(dirpath, mtime), True
+        return record, False
+
+    @staticmethod
+    def _scan_dir(dirpath: str, mtime: int) -> dict:
+        '''
+        Lists a single directory.
+        Parameters
+        ----------
+        dirpath : str
+            Directory to list.
+        mtime : int
+            mtime (ns) of the directory, recorded to detect later changes.
+        Returns
+        -------
+        dict
+            Directory record.
+        '''
+        subdirs = []
+        files = []
+        with os.scandir(dirpath) as it:
+            for entry in it:
+                if(entry.is_dir()):
+                    subdirs.append(entry.name)
+                elif(entry.is_file()):
+                    st = entry.stat()
+                    files.append((entry.name, st.st_size, st.st_mtime_ns))
+        subdirs.sort()
+        files.sort()
+        entities = {f[0]: dict(entity_splitter(f[0])) for f in files if is_image(f[0])}
+        tabular = None
+        if(os.path.basename(dirpath).startswith('sub-')):
+            # Assumes that only one .csv is present in the subject directory
+            csvs = [f[0] for f in files if f[0].endswith('.csv')]
+            if(len(csvs) > 0):
+                tabular = os.path.join(dirpath, csvs[0])
+        return {'mtime': mtime, 'subdirs': subdirs, 'files': files, 'entities': entities, 'tabular': tabular}
+
+    def entries(self) -> list:
+        '''
+        Returns every image in the index, in breadth-first directory order.
+        Returns
+        -------
+        list
+            List of IndexEntry.
+        '''
+        entries = []
+        for dirpath, record in self.dirs.items():
+            if(len(record['entities']) == 0 or (self.top_dirs is not None and dirpath == self.root_dir)):
+                continue
+            for name, size, mtime in record['files']:
+                if(name not in record['entities']):
+                    continue
+                ent_dict = record['entities'][name]
+                entries.append(IndexEntry(name, os.path.join(dirpath, name), size, mtime, ent_dict,
+                                          self._find_tabular(dirpath, ent_dict.get('sub', ''))))
+        return entries
+
+    def _find_tabular(self, dirpath: str, sub_name: str):
+        '''
+        Returns the tabular file of the subject directory above dirpath, or None.
+        '''
+        sub_dir = dirpath.split('sub-' + sub_name)[0]
+        sub_dir = os.path.join(sub_dir, f'sub-{sub_name}')
+        record = self.dirs.get(sub_dir)
+        if(record is None):
+            return None
+        return record['tabular']
+
+    def save(self, index_file: str):
+        '''
+        Writes the index to disk. The file is replaced atomically, so concurrent readers never see a partial index.
+        Parameters
+        ----------
+        index_file : str
+            Path of the index file.
+        '''
+        tmp_file = f'{index_file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'wb') as f:
+            pickle.dump({'version': self.INDEX_VERSION, 'root_dir': self.root_dir, 'top_dirs': self.top_dirs,
+                         'dirs': self.dirs}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, index_file)
+
+    @classmethod
+    def load(cls, index_file: str):
+        '''
+        Reads an index written by save().
+        Parameters
+        ----------
+        index_file : str
+            Path of the index file.
+        Returns
+        -------
+        DatasetIndex
+        '''
+        with open(index_file, 'rb') as f:
+            state = pickle.load(f)
+        if(state.get('version') != cls.INDEX_VERSION):
+            raise ValueError(f'Index file {index_file} has version {state.get("version")}; '
+                             f'expected {cls.INDEX_VERSION}. Delete it to rebuild.')
+        index = cls(state['root_dir'], top_dirs=state.get('top_dirs'))
+        index.dirs = state['dirs']
+        return index
+
+    @classmethod
+    def open(cls, index_file: str, root_dir: str = None, refresh: bool = True, num_threads: int = None,
+             top_dirs: list = None):
+        '''
+        Loads the index from index_file, building it from root_dir if the file does not exist yet. The index is saved
+        back to index_file whenever it is built or changes during the refresh.
+        Parameters
+        ----------
+        index_file : str
+            Path of the index file.
+        root_dir : str
+            Optional. Root directory of the BIDS data. Required if index_file does not exist. If the index exists but
+            was built for a different root, it is rebuilt.
+        refresh : bool
+            Optional. Whether to rescan directories whose mtime changed. If False, the index is used as-is.
+        num_threads : int
+            Optional. Number of threads used to scan directories; see refresh.
+        top_dirs : list
+            Optional. Top-level directories to index (see __init__). If the saved index covers other directories, it
+            is refreshed to cover these ones (only new directories are scanned), unless refresh is False.
+        Returns
+        -------
+        DatasetIndex
+        '''
+        index = None
+        if(os.path.isfile(index_file)):
+            index = cls.load(index_file)
+            if(root_dir is not None and os.path.normpath(index.root_dir) != os.path.normpath(root_dir)):
+                index = None
+        if(index is None):
+            if(root_dir is None):
+                raise ValueError(f'Index file {index_file} does not exist and root_dir is not defined.')
+            index = cls(root_dir, top_dirs=top_dirs)
+            index.refresh(num_threads=num_threads)
+            index.save(index_file)
+        elif(refresh and top_dirs is not None and index.top_dirs != sorted(top_dirs)):
+            index.top_dirs = sorted(top_dirs)
+            index.refresh(num_threads=num_threads)
+            index.save(index_file)
+        elif(refresh):
+            if(index.refresh(num_threads=num_threads) > 0):
+                index.save(index_file)
+        return index
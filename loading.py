@@ -0,0 +1,110 @@
+import nibabel as nb
+import numpy as np
+import os
+import torch as T
+from .profiling import NULL_PROFILER
+
+# Integer types that torch cannot represent, and the type they are widened to
+_TORCH_UNSUPPORTED = {np.dtype(np.uint16): np.int32, np.dtype(np.uint32): np.int64, np.dtype(np.uint64): np.int64}
+
+
+def load_volume(path: str, memmap: bool = False, profiler=NULL_PROFILER, dtype: T.dtype = None) -> T.Tensor:
+    '''
+    Loads the image data of a NIfTI file as a Tensor.
+    Parameters
+    ----------
+    path : str
+        Path of the image.
+    memmap : bool
+        Optional. If False, data is read with get_fdata() (float64) and converted to a float32 Tensor.
+        If True, data keeps its on-disk dtype: uncompressed .nii files are memory-mapped and wrapped without copying
+        (pages are read on first access), .nii.gz files are decompressed once. Scaling (scl_slope/scl_inter) is only
+        applied if the header defines it, in which case the result is float32.
+    profiler : StageProfiler
+        Optional. Records the 'open' (header), 'read' (read and decompression, with the file size as bytes; lazy for
+        memory-mapped files) and 'convert' (dtype conversion and scaling) stages. See profiling.StageProfiler.
+    dtype : torch.dtype
+        Optional. Output type (e.g. T.uint8 for masks, T.float16 for images). Data is read in its on-disk type and
+        converted once, with the scaling applied in the same pass if the header defines it; no float64 copy is made.
+        Defaults to float32 if memmap is False, the on-disk type (or float32 if scaled) otherwise.
+    Returns
+    -------
+    Tensor
+        Image data.
+    '''
+    nbytes = os.path.getsize(path) if profiler.enabled else 0
+    if(not memmap and dtype is None):
+        with profiler.stage('open'):
+            img = nb.load(path)
+        with profiler.stage('read', nbytes):
+            arr = img.get_fdata()
+        with profiler.stage('convert'):
+            return T.Tensor(arr)
+    with profiler.stage('open'):
+        img = nb.load(path, mmap='c' if memmap else False)
+    proxy = img.dataobj
+    with profiler.stage('read', nbytes):
+        arr = proxy.get_unscaled()
+    with profiler.stage('convert'):
+        return scale_tensor(array_to_tensor(arr), proxy.slope, proxy.inter, dtype=dtype)
+
+
+def array_to_tensor(arr: np.ndarray) -> T.Tensor:
+    '''
+    Wraps a NumPy array (including a memmap) in a Tensor without copying, when torch supports its dtype and byte order.
+    Otherwise, the array is converted (copied) first.
+    Parameters
+    ----------
+    arr : np.ndarray
+        Array to wrap.
+    Returns
+    -------
+    Tensor
+        Tensor sharing memory with arr where possible.
+    '''
+    if(not arr.dtype.isnative):
+        arr = arr.astype(arr.dtype.newbyteorder('='))
+    if(arr.dtype in _TORCH_UNSUPPORTED):
+        arr = arr.astype(_TORCH_UNSUPPORTED[arr.dtype])
+    if(not arr.flags.writeable):
+        # torch.from_numpy warns on read-only memory
+        arr = arr.copy()
+    return T.from_numpy(arr)
+
+
+def scale_tensor(dat: T.Tensor, slope: float, inter: float, dtype: T.dtype = None) -> T.Tensor:
+    '''
+    Applies NIfTI intensity scaling (dat * slope + inter). Returns dat unchanged when the scaling is the identity and
+    no dtype is requested.
+    Parameters
+    ----------
+    dat : Tensor
+        Unscaled data.
+    slope : float
+        Scaling slope.
+    inter : float
+        Scaling intercept.
+    dtype : torch.dtype
+        Optional. Output type. Floating point values are rounded when converted to integer types.
+    Returns
+    -------
+    Tensor
+        Scaled data; float32 if scaling was applied, unless dtype is defined.
+    '''
+    if(slope == 1 and inter == 0):
+        if(dtype is None or dat.dtype == dtype):
+            return dat
+        if(dat.is_floating_point() and not dtype.is_floating_point):
+            return dat.round().to(dtype)
+        return dat.to(dtype)
+    if(dat.is_floating_point() and dat.dtype != T.float32):
+        dat = dat.to(T.float32)
+    # The first operation converts (integers are promoted to float32) and scales in a single pass
+    out = dat * float(slope) if slope != 1 else dat + float(inter)
+    if(slope != 1 and inter != 0):
+        out.add_(float(inter))
+    if(dtype is not None and dtype != out.dtype):
+        if(not dtype.is_floating_point):
+            out.round_()
+        out = out.to(dtype)
+    return out
@@ -0,0 +1,113 @@
+import numpy as np
+from torch.utils.data import IterableDataset, get_worker_info
+from .qbids import QuickBIDS
+from .sharding import draw_order_seed
+
+
+class PatchQueue(IterableDataset):
+    def __init__(self, dataset: QuickBIDS,
+                 patch_size: tuple,
+                 patches_per_volume: int = 8,
+                 queue_length: int = 64,
+                 shuffle: bool = True,
+                 seed: int = None):
+        '''
+        Iterable dataset of random patches drawn from a QuickBIDS dataset. Each image contributes patches_per_volume
+        patches, which are read with QuickBIDS.get_patch so that only the patch regions are read where the storage
+        allows it (uncompressed .nii, volume cache). Images that must be decompressed in full (.nii.gz without a volume
+        cache) are loaded once and all their patches are cut from memory.
+        Patches are pushed into a queue of queue_length entries and drawn from it at random, so that consecutive
+        patches mostly come from different images.
+        Compatible with multiple DataLoader workers: each worker handles a distinct subset of the images.
+        Parameters
+        ----------
+        dataset : QuickBIDS
+            Dataset from which to draw patches. Its preprocess_list is applied to each patch.
+        patch_size : tuple
+            Size of the patches, one entry per leading axis of the images (e.g. (64, 64, 64)). Images smaller than a
+            patch along an axis are taken whole along that axis.
+        patches_per_volume : int
+            Optional. Number of patches drawn from each image.
+        queue_length : int
+            Optional. Maximum number of patches held in memory.
+        shuffle : bool
+            Optional. Whether to shuffle images and patches. If False, patches are returned in image order.
+        seed : int
+            Optional. Seed for image order and patch locations. Call set_epoch() at the start of every epoch to vary the
+            image order (and, if seeded, the patch locations) between epochs.
+        '''
+        self.dataset = dataset
+        self.patch_size = tuple(patch_size)
+        self.patches_per_volume = patches_per_volume
+        self.queue_length = max(queue_length, 1)
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._order_seed = draw_order_seed()
+
+    def set_epoch(self, epoch: int):
+        '''
+        Sets the epoch, so that a seeded queue draws different patches every epoch.
+        '''
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.dataset) * self.patches_per_volume
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = 0 if worker_info is None else worker_info.id
+        num_workers = 1 if worker_info is None else worker_info.num_workers
+        if(self.seed is None):
+            rng = np.random.default_rng()
+        else:
+            rng = np.random.default_rng([self.seed, self.epoch, worker_id])
+
+        indices = np.arange(len(self.dataset))
+        if(self.shuffle):
+            # Every worker must draw the same permutation before taking its share
+            order_seed = self.seed if self.seed is not None else self._order_seed
+            indices = np.random.default_rng([order_seed, self.epoch]).permutation(indices)
+        indices = indices[worker_id::num_workers]
+
+        queue = []
+        for idx in indices:
+            queue.extend(self._patches(idx, rng))
+            while(len(queue) >= self.queue_length):
+                yield self._pop(queue, rng)
+        while(len(queue) > 0):
+            yield self._pop(queue, rng)
+
+    def _pop(self, queue: list, rng: np.random.Generator):
+        '''
+        Removes and returns a random entry of queue (the first one if not shuffling).
+        '''
+        if(not self.shuffle):
+            return queue.pop(0)
+        i = rng.integers(len(queue))
+        queue[i], queue[-1] = queue[-1], queue[i]
+        return queue.pop()
+
+    def _patches(self, idx: int, rng: np.random.Generator) -> list:
+        '''
+        Draws patches_per_volume patches from image idx.
+        '''
+        shape = self.dataset.volume_shape(idx)
+        slices_list = []
+        for _ in range(self.patches_per_volume):
+            slices = []
+            for dim, size in zip(shape, self.patch_size):
+                size = min(size, dim)
+                start = int(rng.integers(dim - size + 1))
+                slices.append(slice(start, start + size))
+            slices_list.append(tuple(slices))
+
+        file_path = self.dataset.file_path_dict[self.dataset.file_list[idx]]
+        if(self.dataset.volume_cache is None and file_path.endswith('.gz')):
+            # Partial reads would decompress the file once per patch; decode it once instead
+            file = self.dataset.file_list[idx]
+            dat = self.dataset._load_sample(file)
+            # Grouped samples have a leading channel axis
+            lead = (slice(None),) if self.dataset.group_dict is not None else ()
+            return [self.dataset._finish(file, dat[lead + slices].clone()) for slices in slices_list]
+        return [self.dataset.get_patch(idx, slices) for slices in slices_list]
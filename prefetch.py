@@ -0,0 +1,198 @@
+import warnings
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import torch as T
+from torch.utils.data import IterableDataset, RandomSampler, SubsetRandomSampler, WeightedRandomSampler, get_worker_info
+from .sharding import draw_order_seed
+
+
+def to_device(obj, device, non_blocking: bool = False, pin_memory: bool = False):
+    '''
+    Moves every Tensor in a (possibly nested) batch to device. Lists, tuples and dicts are traversed; other objects are
+    returned as-is.
+    Parameters
+    ----------
+    obj
+        Tensor, or list/tuple/dict containing Tensors.
+    device : str
+        Target device.
+    non_blocking : bool
+        Optional. Whether to copy asynchronously (only effective from pinned memory to CUDA).
+    pin_memory : bool
+        Optional. Whether to pin CPU Tensors before copying them.
+    Returns
+    -------
+    Same structure as obj, with Tensors on device.
+    '''
+    if(isinstance(obj, T.Tensor)):
+        if(pin_memory and obj.device.type == 'cpu' and not obj.is_pinned()):
+            obj = obj.pin_memory()
+        return obj.to(device, non_blocking=non_blocking)
+    elif(isinstance(obj, dict)):
+        return {k: to_device(v, device, non_blocking, pin_memory) for k, v in obj.items()}
+    elif(isinstance(obj, tuple) and hasattr(obj, '_fields')):
+        return type(obj)(*(to_device(v, device, non_blocking, pin_memory) for v in obj))
+    elif(isinstance(obj, (list, tuple))):
+        return type(obj)(to_device(v, device, non_blocking, pin_memory) for v in obj)
+    return obj
+
+
+def _record_stream(obj, stream):
+    '''
+    Marks every CUDA Tensor in obj as used by stream, so that its memory is not reused before stream is done with it.
+    '''
+    if(isinstance(obj, T.Tensor)):
+        if(obj.is_cuda):
+            obj.record_stream(stream)
+    elif(isinstance(obj, dict)):
+        for v in obj.values():
+            _record_stream(v, stream)
+    elif(isinstance(obj, (list, tuple))):
+        for v in obj:
+            _record_stream(v, stream)
+
+
+class DevicePrefetcher:
+    def __init__(self, loader, device: str = 'cuda:0', pin_memory: bool = True):
+        '''
+        Wraps a DataLoader so that batches are moved to the device asynchronously: while the current batch is being
+        used, the next one is copied on a separate CUDA stream. Use with a dataset that returns CPU Tensors (e.g.
+        QuickBIDS with device=None, or any QuickBIDS in DataLoader workers) and DataLoader(pin_memory=True), so that
+        batches arrive in pinned memory.
+        If device is not a CUDA device, or CUDA is not available, batches are moved synchronously (to the CPU if CUDA
+        was requested but is unavailable).
+        Parameters
+        ----------
+        loader : iterable
+            DataLoader (or any iterable of batches).
+        device : str
+            Optional. Target device.
+        pin_memory : bool
+            Optional. Whether to pin batches that are not already in pinned memory before copying them to CUDA.
+        '''
+        self.loader = loader
+        self.device = T.device(device)
+        self.pin_memory = pin_memory
+        if(self.device.type == 'cuda' and not T.cuda.is_available()):
+            warnings.warn(f'CUDA is not available; DevicePrefetcher falls back to the CPU instead of {device}')
+            self.device = T.device('cpu')
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if(self.device.type != 'cuda'):
+            for batch in self.loader:
+                yield to_device(batch, self.device)
+            return
+
+        stream = T.cuda.Stream(device=self.device)
+        it = iter(self.loader)
+
+        def preload():
+            try:
+                batch = next(it)
+            except StopIteration:
+                return None, False
+            with T.cuda.stream(stream):
+                batch = to_device(batch, self.device, non_blocking=True, pin_memory=self.pin_memory)
+            return batch, True
+
+        next_batch, has_next = preload()
+        while has_next:
+            current_stream = T.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            batch = next_batch
+            _record_stream(batch, current_stream)
+            # Start copying the following batch before handing this one over
+            next_batch, has_next = preload()
+            yield batch
+
+
+class ReadAhead(IterableDataset):
+    def __init__(self, dataset, sampler=None, depth: int = 16, num_threads: int = 8, shuffle: bool = False,
+                 seed: int = None):
+        '''
+        Iterable wrapper that reads samples ahead of time: it follows the index order of sampler and keeps up to depth
+        reads (dataset[idx]) in flight in a thread pool, returning samples in order. On high-latency storage (NFS,
+        Lustre) throughput then scales with the number of concurrent reads rather than with the number of DataLoader
+        workers; decompression in nibabel also releases the GIL for most of its work.
+        Use as the dataset of a DataLoader (without a sampler, since the order comes from sampler). With multiple
+        workers, each worker reads ahead its own share of the epoch order, which must therefore be the same in every
+        worker, and change between epochs although workers iterate copies of the sampler: use shuffle=True and
+        set_epoch() to shuffle, or a sampler whose order is set by a seed and set_epoch() (e.g.
+        sharding.ShardSampler or DistributedSampler).
+        Parameters
+        ----------
+        dataset : Dataset
+            Map-style dataset, e.g. QuickBIDS.
+        sampler : Sampler
+            Optional. Provides the index order; iterated once per epoch. Defaults to sequential order (shuffled if
+            shuffle is True). With multiple workers, torch's random samplers (which have no set_epoch) are rejected.
+        depth : int
+            Optional. Maximum number of samples read ahead.
+        num_threads : int
+            Optional. Number of reader threads.
+        shuffle : bool
+            Optional. Whether to shuffle the order, without a sampler. Call set_epoch() at the start of every epoch to
+            draw a new order.
+        seed : int
+            Optional. Seed of the shuffled order.
+        '''
+        self.dataset = dataset
+        self.sampler = sampler
+        self.depth = max(depth, 1)
+        self.num_threads = num_threads
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._order_seed = draw_order_seed()
+
+    def __len__(self):
+        return len(self.sampler) if self.sampler is not None else len(self.dataset)
+
+    def set_epoch(self, epoch: int):
+        '''
+        Sets the epoch of the shuffled order, and forwards it to the sampler (e.g. DistributedSampler) if it supports
+        it.
+        '''
+        self.epoch = epoch
+        if(hasattr(self.sampler, 'set_epoch')):
+            self.sampler.set_epoch(epoch)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        num_workers = worker_info.num_workers if worker_info is not None else 1
+        if(self.sampler is None):
+            indices = np.arange(len(self.dataset))
+            if(self.shuffle):
+                order_seed = self.seed if self.seed is not None else self._order_seed
+                indices = np.random.default_rng([order_seed, self.epoch]).permutation(indices)
+            indices = indices.tolist()
+        else:
+            if(num_workers > 1 and isinstance(self.sampler, (RandomSampler, SubsetRandomSampler, WeightedRandomSampler))
+               and not hasattr(self.sampler, 'set_epoch')):
+                # Unseeded, every worker would draw its own permutation, repeating some samples and skipping others;
+                # seeded, every epoch would repeat the same order, since the workers' copies of the generator are
+                # discarded
+                raise ValueError('Random samplers cannot be used when ReadAhead runs in several DataLoader workers; '
+                                 'use ReadAhead(shuffle=True) and call set_epoch() at the start of every epoch')
+            indices = list(self.sampler)
+        if(worker_info is not None):
+            indices = indices[worker_info.id::num_workers]
+
+        pool = ThreadPoolExecutor(max_workers=self.num_threads)
+        pending = deque()
+        try:
+            for idx in indices:
+                pending.append(pool.submit(self.dataset.__getitem__, idx))
+                if(len(pending) >= self.depth):
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # Iteration stopped early (or failed): drop reads that have not started
+            for fut in pending:
+                fut.cancel()
+            pool.shutdown(wait=True)
@@ -0,0 +1,274 @@
+import json
+import multiprocessing as mp
+import os
+import threading
+import time
+import numpy as np
+from contextlib import contextmanager, nullcontext
+from multiprocessing.util import Finalize
+from torch.utils.data import get_worker_info
+
+# Histogram bins: log-spaced from 1 us to 100 s, HIST_BINS_PER_DECADE per decade, plus under/overflow bins
+HIST_MIN_S = 1e-6
+HIST_DECADES = 8
+HIST_BINS_PER_DECADE = 10
+HIST_EDGES = HIST_MIN_S * 10 ** (np.arange(HIST_DECADES * HIST_BINS_PER_DECADE + 1) / HIST_BINS_PER_DECADE)
+
+
+class NullProfiler:
+    '''
+    Profiler that records nothing; used when profiling is disabled, so that instrumented code only pays for a method
+    call.
+    '''
+    enabled = False
+    _context = nullcontext()
+
+    def stage(self, name: str, nbytes: int = 0):
+        return self._context
+
+    def record(self, name: str, start: float, duration: float, nbytes: int = 0):
+        pass
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class StageProfiler:
+    enabled = True
+
+    def __init__(self, max_events: int = 100000, flush_interval: float = 1.0):
+        '''
+        Records the duration (and bytes, where known) of every stage of sample loading, e.g. with
+        QuickBIDS(profile=True): file open, read/decompression, dtype conversion, each preprocessing function, tabular
+        lookup and device copy.
+        Each process (main, or DataLoader worker) aggregates its own timings into per-stage counters and histograms,
+        and publishes them every flush_interval seconds and when it exits. summary() and histogram() combine all
+        processes and can be called at any time; export_chrome_trace() writes per-worker timelines.
+        Must be created in the main process, before the DataLoader starts its workers. Call close() when done.
+        Parameters
+        ----------
+        max_events : int
+            Optional. Maximum number of individual events kept per process for the trace. Counters and histograms
+            are always updated.
+        flush_interval : float
+            Optional. Seconds between two publications of a worker's timings.
+        '''
+        self.max_events = max_events
+        self.flush_interval = flush_interval
+        self._manager = mp.Manager()
+        # (pid, label) -> aggregate snapshot of that process
+        self._snapshots = self._manager.dict()
+        self._events = self._manager.list()
+        # Incremented by reset(), so that workers discard their counts too
+        self._generation = self._manager.Value('i', 0)
+        self._owner_pid = os.getpid()
+        self._reset_local()
+
+    def __getstate__(self):
+        # The manager itself stays in the main process; workers only need the proxies. Local data is not copied.
+        state = self.__dict__.copy()
+        state['_manager'] = None
+        for k in ['_lock', '_stages', '_local_events', '_finalizer']:
+            state[k] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset_local()
+
+    def _reset_local(self):
+        self._lock = threading.Lock()
+        # stage -> [count, total seconds, bytes, histogram]
+        self._stages = {}
+        self._local_events = []
+        self._n_events = 0
+        self._last_flush = time.perf_counter()
+        self._finalizer = None
+        self._pid = os.getpid()
+        self._local_generation = None
+        self._worker_label = None
+
+    @contextmanager
+    def stage(self, name: str, nbytes: int = 0):
+        '''
+        Context manager timing a stage.
+        Parameters
+        ----------
+        name : str
+            Name of the stage.
+        nbytes : int
+            Optional. Bytes processed by the stage.
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start, nbytes)
+
+    def record(self, name: str, start: float, duration: float, nbytes: int = 0):
+        '''
+        Records a stage that started at start (time.perf_counter()) and lasted duration seconds.
+        '''
+        if(os.getpid() != self._pid):
+            # Forked without pickling (e.g. DataLoader workers with the fork start method)
+            self._reset_local()
+        with self._lock:
+            entry = self._stages.get(name)
+            if(entry is None):
+                entry = self._stages[name] = [0, 0.0, 0, np.zeros(len(HIST_EDGES) + 1, dtype=np.int64)]
+            entry[0] += 1
+            entry[1] += duration
+            entry[2] += nbytes
+            entry[3][np.searchsorted(HIST_EDGES, duration)] += 1
+            if(self._n_events < self.max_events):
+                self._local_events.append((name, start, duration, nbytes, threading.get_ident()))
+                self._n_events += 1
+        if(self._pid != self._owner_pid):
+            if(self._finalizer is None):
+                # Worker info is no longer available when the process exits
+                worker_info = get_worker_info()
+                self._worker_label = f'worker {worker_info.id}' if worker_info is not None else f'process {self._pid}'
+                # Runs when the worker process exits normally
+                self._finalizer = Finalize(self, self.flush, exitpriority=10)
+            if(start + duration - self._last_flush > self.flush_interval):
+                self.flush()
+
+    def _label(self) -> str:
+        if(self._pid == self._owner_pid):
+            return 'main'
+        return self._worker_label or f'process {self._pid}'
+
+    def _snapshot(self) -> dict:
+        return {name: (e[0], e[1], e[2], e[3].tolist()) for name, e in self._stages.items()}
+
+    def flush(self):
+        '''
+        Publishes this process' timings. Called automatically in workers.
+        '''
+        if(self._pid == self._owner_pid or self._snapshots is None):
+            return
+        try:
+            generation = self._generation.value
+        except (OSError, EOFError):
+            # The manager has been shut down
+            return
+        with self._lock:
+            if(self._local_generation is not None and generation != self._local_generation):
+                self._stages = {}
+                self._local_events = []
+                self._n_events = 0
+            self._local_generation = generation
+            snapshot = self._snapshot()
+            events = self._local_events
+            self._local_events = []
+            self._last_flush = time.perf_counter()
+        label = self._label()
+        try:
+            self._snapshots[(self._pid, label)] = snapshot
+            if(len(events) > 0):
+                self._events.extend([(self._pid, label) + e for e in events])
+        except (OSError, EOFError):
+            pass
+
+    def _merged(self) -> dict:
+        '''
+        Returns the combined aggregates of every process: stage -> [count, total seconds, bytes, histogram].
+        '''
+        snapshots = list(dict(self._snapshots).values()) if self._manager is not None else []
+        with self._lock:
+            snapshots.append(self._snapshot())
+        merged = {}
+        for snapshot in snapshots:
+            for name, (count, total, nbytes, hist) in snapshot.items():
+                entry = merged.setdefault(name, [0, 0.0, 0, np.zeros(len(HIST_EDGES) + 1, dtype=np.int64)])
+                entry[0] += count
+                entry[1] += total
+                entry[2] += nbytes
+                entry[3] += np.asarray(hist)
+        return merged
+
+    def summary(self) -> dict:
+        '''
+        Returns per-stage statistics over all processes: count, total_s, mean_ms, p50_ms / p90_ms / p95_ms / p99_ms
+        (approximated from the histogram, within about 12%), bytes and mb_per_s.
+        '''
+        summary = {}
+        for name, (count, total, nbytes, hist) in self._merged().items():
+            stats = {'count': int(count), 'total_s': total, 'mean_ms': 1000 * total / max(count, 1),
+                     'bytes': int(nbytes), 'mb_per_s': nbytes / 2 ** 20 / total if total > 0 else 0.0}
+            cumulative = np.cumsum(hist)
+            for q in [50, 90, 95, 99]:
+                b = int(np.searchsorted(cumulative, q / 100 * count))
+                # Upper edge of the bin holding the quantile
+                stats[f'p{q}_ms'] = 1000 * float(HIST_EDGES[min(b, len(HIST_EDGES) - 1)])
+            summary[name] = stats
+        return summary
+
+    def histogram(self, name: str):
+        '''
+        Returns the histogram of the durations of a stage, over all processes.
+        Returns
+        -------
+        np.ndarray
+            Bin edges, in seconds. The first and last bins of the counts hold durations below and above them.
+        np.ndarray
+            Counts, one more than the edges.
+        '''
+        merged = self._merged()
+        counts = merged[name][3] if name in merged else np.zeros(len(HIST_EDGES) + 1, dtype=np.int64)
+        return HIST_EDGES.copy(), counts
+
+    def report(self) -> str:
+        '''
+        Returns summary() as a table, stages sorted by total time.
+        '''
+        lines = [f'{"stage":<28}{"count":>9}{"total s":>10}{"mean ms":>10}{"p50 ms":>10}{"p99 ms":>10}{"MB/s":>10}']
+        for name, s in sorted(self.summary().items(), key=lambda kv: -kv[1]['total_s']):
+            lines.append(f'{name:<28}{s["count"]:>9}{s["total_s"]:>10.3f}{s["mean_ms"]:>10.3f}{s["p50_ms"]:>10.3f}'
+                         f'{s["p99_ms"]:>10.3f}{s["mb_per_s"]:>10.1f}')
+        return '\n'.join(lines)
+
+    def export_chrome_trace(self, trace_file: str):
+        '''
+        Writes the recorded events in the Chrome trace format (open with chrome://tracing or Perfetto), with one
+        timeline per process and thread.
+        Parameters
+        ----------
+        trace_file : str
+            Path of the JSON file to write.
+        '''
+        with self._lock:
+            events = [(self._pid, self._label()) + e for e in self._local_events]
+        if(self._manager is not None):
+            events = list(self._events) + events
+        trace = []
+        for pid, label in sorted({(e[0], e[1]) for e in events}):
+            trace.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': label}})
+        for pid, _, name, start, duration, nbytes, tid in events:
+            trace.append({'name': name, 'ph': 'X', 'pid': pid, 'tid': tid, 'ts': start * 1e6, 'dur': duration * 1e6,
+                          'args': {'bytes': nbytes}})
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+    def reset(self):
+        '''
+        Discards everything recorded so far. Running workers discard their counts at their next flush.
+        '''
+        with self._lock:
+            self._stages = {}
+            self._local_events = []
+            self._n_events = 0
+        if(self._manager is not None):
+            self._generation.value += 1
+            self._snapshots.clear()
+            del self._events[:]
+
+    def close(self):
+        '''
+        Stops the manager process. Must be called from the process that created the profiler; local timings stay
+        available.
+        '''
+        if(self._manager is None):
+            return
+        self._manager.shutdown()
+        self._manager = None
@@ -1,9 +1,21 @@
+import copy
 import nibabel as nb
-import pandas as pd
+import numpy as np
 import os
 import torch as T
+import warnings
 from collections import defaultdict as dd
+from concurrent.futures import ThreadPoolExecutor
+from torch.utils.data import get_worker_info
 from torch.utils.data.dataset import Dataset
+from .entities import EntityTable, entity_splitter, is_image
+from .crawl import crawl, parse_file_list
+from .index import DatasetIndex
+from .loading import array_to_tensor, load_volume, scale_tensor
+from .profiling import NULL_PROFILER, StageProfiler
+from .sharding import assign_shards, get_rank_info, subject_dir_key, subject_dirs, subject_of
+from .tabular import PhenotypeStore, TabularCache
+from .volume_cache import VolumeCache
 
 class QuickBIDS(Dataset):
     def __init__(self, root_dir: str = None,
@@ -12,7 +24,23 @@ class QuickBIDS(Dataset):
                  tabular_to_fetch: list = None,
                  preprocess_list: list = None,
                  verbose: bool = True,
-                 device: str = 'cuda:0'):
+                 device: str = 'cuda:0',
+                 index_file: str = None,
+                 refresh_index: bool = True,
+                 crawl_threads: int = None,
+                 tabular_cache: str = None,
+                 memmap: bool = False,
+                 volume_cache=None,
+                 shared_cache=None,
+                 rank: int = None,
+                 world_size: int = None,
+                 tabular_store: str = None,
+                 tabular_key: dict = None,
+                 profile=False,
+                 dtypes: dict = None,
+                 group_by: list = None,
+                 group_members: list = None,
+                 group_entity: str = 'suffix'):
         '''
         Creates a Pytorch-compatible dataset for a fixed BIDS directory.
         Parameters
@@ -22,17 +50,92 @@ class QuickBIDS(Dataset):
         file_of_files : str
             Optional. File containing a list of the files to load. Avoids having to walk the directory.
         entities_to_match : dict
-            Optional. If defined, will only select files which match the specified entities.
+            Optional. If defined, will only select files which match all the specified entities.
             Example: entities_to_match = {'sub':'1234'} will return only files with subject 1234.
+            Values can also be lists, ranges (slice) or compiled regular expressions, and a list of dicts selects files
+            matching any of them; see entities.EntityTable.query.
         tabular_to_fetch : list
-            Optional. List of str corresponding to column entries to fetch.
+            Optional. List of str corresponding to column entries to fetch. Images without tabular data get an empty
+            list; a warning at construction reports how many there are.
         preprocess_list : list
             Optional. List of preprocessing functions to apply to the loaded image before returning. Listed functions
-            are applied in the order in which they appear in the list.
+            are applied in the order in which they appear in the list. A transformations.pipeline.Pipeline can be
+            given instead of (or in) the list, to fuse consecutive affine transformations into one resampling.
         verbose : bool
             Whether to print dataset info.
         device : str
-            Device to use for the Pytorch tensor.
+            Device to use for the Pytorch tensor. If None, data stays on the CPU. Inside DataLoader workers, data always
+            stays on the CPU (CUDA cannot be used there); use DataLoader(pin_memory=True) and prefetch.DevicePrefetcher
+            to move whole batches to the device asynchronously. If CUDA is not available, a warning is issued and data
+            stays on the CPU.
+        index_file : str
+            Optional. Path of a persistent dataset index (see index.DatasetIndex). If the file does not exist, it is
+            built by walking root_dir and saved; otherwise the directory walk is replaced by loading the index. Ignored
+            if file_of_files is defined.
+        refresh_index : bool
+            Optional. If True, directories whose mtime changed since the index was saved are rescanned (and the index
+            file is updated). If False, the index is used as-is and root_dir is not accessed at all.
+        crawl_threads : int
+            Optional. If defined, root_dir (or the index) is crawled with os.scandir, listing directories concurrently
+            with this many threads. Recommended on network filesystems, where the serial walk is latency-bound.
+        tabular_cache : str
+            Optional. Parquet (.parquet) or Feather file in which the consolidated tabular data is saved, and from which
+            it is loaded on later runs (e.g. next to index_file). Requires pyarrow. Tabular data is always read once at
+            construction; without this file, it is simply kept in memory.
+        memmap : bool
+            Optional. If True, images keep their on-disk dtype (e.g. int16, uint8) instead of being converted to
+            float32 through float64, and uncompressed .nii files are memory-mapped rather than read. Intensity scaling
+            is applied in torch only if the header defines it. See loading.load_volume.
+        volume_cache : str or VolumeCache
+            Optional. Convert-once cache (volume_cache.VolumeCache, or the path of its directory): each image is
+            decoded on first access and stored in a fast raw format, which later epochs read (memory-mapped) instead of
+            decompressing the original file.
+        shared_cache : SharedVolumeCache
+            Optional. Cache of decoded images in shared memory (shared_cache.SharedVolumeCache), so that DataLoader
+            workers share one copy of each image instead of decoding it separately. Preprocessing is applied after the
+            cache.
+        rank : int
+            Optional. Rank of this process in distributed training. With world_size, the dataset only holds this rank's
+            shard: subjects are split between ranks (no subject is in two shards), balanced by number of files with
+            file_of_files, and by number of subject directories otherwise. Only this rank's subject directories are
+            crawled, or its lines of file_of_files parsed. With index_file, each rank indexes only its own subject
+            directories, in its own file ('<index_file>.<rank>-of-<world_size>'); an existing index_file used with
+            refresh_index=False is instead read by every rank (and not written), with shards balanced by file size.
+            Use sharding.ShardSampler for a deterministic, seeded order per epoch. Defaults to torch.distributed's
+            rank.
+        world_size : int
+            Optional. Number of ranks; enables sharding. Defaults to torch.distributed's world size if rank is defined.
+        tabular_store : str
+            Optional. Parquet (.parquet) or Feather file holding the tabular data of all subjects (see
+            utilities.csv_to_store). If defined, tabular_to_fetch is read from it (only those columns are loaded)
+            instead of from per-subject .csv files, which are then not looked up. Requires pyarrow.
+        tabular_key : dict
+            Optional. Mapping of the key columns of tabular_store to the entities they match, e.g.
+            {'eid': 'sub', 'visit': 'ses'}. Values are compared as str. Defaults to {'eid': 'sub'}.
+        profile : bool or StageProfiler
+            Optional. If True (or a profiling.StageProfiler), the duration of every loading stage is recorded, in the
+            main process and in DataLoader workers: open, read (with bytes), convert, caches, each preprocessing
+            function, device copy, tabular lookup and the whole sample. Query self.profiler.summary() or
+            .export_chrome_trace() at any time. Disabled profiling costs close to nothing.
+        dtypes : dict
+            Optional. Output dtype per file suffix, e.g. {'dseg': T.uint8, 'mask': T.uint8, 'default': T.float16}
+            ('default' applies to other suffixes). Data is read in its on-disk type and converted once, with intensity
+            scaling fused into the conversion when the header defines it (integer outputs are rounded); no float64
+            intermediate is made. Suffixes without an entry (and no 'default') follow the memmap rules.
+        group_by : list
+            Optional. Entities on which to join files into multi-modal samples, e.g. ['sub', 'ses', 'run']. Each
+            entry of the dataset is then one group of files, found in the same crawl, whose members are loaded
+            concurrently and returned stacked as channels, (C, X, Y, Z), in the order of group_members. Members are
+            converted to a common dtype (see dtypes) and must have the same shape. Preprocessing sees the stacked
+            Tensor, so a transformations.pipeline.RandomAffine applies the same random matrix to every member, in one
+            resampling (its interpolation can be a list with one entry per member, e.g. nearest for label maps).
+            Groups missing a member are left out. file_list, entities, tabular data and volume_shape refer to the
+            first member of each group; group_dict maps it to the names of all members.
+        group_members : list
+            Optional. Values of group_entity making up a group, in channel order, e.g. ['T1w', 'T2w', 'FLAIR', 'dseg'].
+            Defaults to every value found, sorted.
+        group_entity : str
+            Optional. Entity telling the members of a group apart.
         '''
 
         # We are making the following assumptions:
@@ -40,67 +143,237 @@ class QuickBIDS(Dataset):
         # - Assumes that tabular data is under sub-X/ directory (one below root, in the subject dir)
         #   - Also assumes that only one .csv is present.
 
+        if(device is not None and T.device(device).type == 'cuda' and not T.cuda.is_available()):
+            warnings.warn(f'CUDA is not available; QuickBIDS keeps data on the CPU instead of {device}')
+            device = None
         self.device = device
+        self.memmap = memmap
+        if(profile is True):
+            profile = StageProfiler()
+        self.profiler = profile if profile else NULL_PROFILER
+        if(isinstance(volume_cache, str)):
+            volume_cache = VolumeCache(volume_cache)
+        self.volume_cache = volume_cache
+        self.shared_cache = shared_cache
+        self._shapes = {}
+        self.dtypes = dtypes
+        self._dtype_cache = {}
+        self.rank = None
+        self.world_size = None
+        self.shard_subjects = None
+        if(rank is not None or world_size is not None):
+            self.rank, self.world_size = get_rank_info(rank, world_size)
         self.tabular_to_fetch = tabular_to_fetch
+        if(callable(preprocess_list)):
+            # A single callable, e.g. a transformations.pipeline.Pipeline
+            preprocess_list = [preprocess_list]
         if(preprocess_list is not None):
             for p in preprocess_list:
                 if(not callable(p)):
                     raise ValueError(f'Preprocessing function {p} is not callable')
         self.preprocess_list = preprocess_list
 
-        if root_dir is None and file_of_files is None:
-            raise ValueError('Either root_dir or file_of_files must be defined.')
+        if root_dir is None and file_of_files is None and index_file is None:
+            raise ValueError('Either root_dir, file_of_files or index_file must be defined.')
 
         self.file_list = []
         self.file_path_dict = dd(str)
-        if(tabular_to_fetch is not None):
+        if(tabular_store is not None and tabular_key is None):
+            tabular_key = {'eid': 'sub'}
+        self.tabular_key = tabular_key if tabular_store is not None else None
+        self.tabular_key_dict = None
+        if(tabular_to_fetch is not None and tabular_store is not None):
+            self.tabular_key_dict = {}
+        find_tabular = tabular_to_fetch is not None and tabular_store is None
+        if(find_tabular):
             self.tabular_path_dict = dd(str)
         else:
             self.tabular_path_dict = None
 
-        if(file_of_files is None):
-            for dirpath, _, files in os.walk(root_dir):
-                for f in files:
-                    ent_dict = self._entity_splitter(f)
-                    # Select only images
-                    if(f.endswith('.nii.gz') or f.endswith('.nii')):
-                        if (entities_to_match is None):
-                            self.file_list.append(f)
-                            self.file_path_dict[f] = os.path.join(dirpath, f)
-                        else:
-                            for ent_name, ent_value in entities_to_match.items():
-                                if(ent_dict[ent_name] == ent_value):
-                                    self.file_list.append(f)
-                                    self.file_path_dict[f] = os.path.join(dirpath, f)
-                        if(tabular_to_fetch is not None):
-                            # get directory
-                            sub_name = ent_dict['sub']
-                            sub_dir = dirpath.split('sub-' + sub_name)[0]
-                            sub_dir = os.path.join(sub_dir, f'sub-{sub_name}')
-                            print(sub_dir)
-                            for s in os.listdir(sub_dir):
-                                if(s.endswith('.csv')):
-                                    self.tabular_path_dict[f] = os.path.join(sub_dir, s)
+        # Candidate images, as (name, path, entities, tabular_path)
+        candidates = []
+        self.index = None
+        if(file_of_files is None and index_file is not None):
+            top_dirs = None
+            shard_index = (self.world_size is not None and root_dir is not None
+                           and (refresh_index or not os.path.isfile(index_file)))
+            if(shard_index):
+                # Each rank indexes (stats, and saves) only its own subject directories, in its own index file
+                top_dirs = self._own_subject_dirs(root_dir)
+                index_file = f'{index_file}.{self.rank}-of-{self.world_size}'
+            self.index = DatasetIndex.open(index_file, root_dir=root_dir, refresh=refresh_index,
+                                           num_threads=crawl_threads, top_dirs=top_dirs)
+            entries = self.index.entries()
+            if(self.world_size is not None and not shard_index):
+                # A saved index used as-is (it is not written) is the same on every rank: balance shards by bytes
+                sizes = dd(int)
+                for entry in entries:
+                    sizes[entry.entities.get('sub', '')] += entry.size
+                own = self._own_shard(sizes)
+                entries = [e for e in entries if e.entities.get('sub', '') in own]
+            for entry in entries:
+                candidates.append((entry.name, entry.path, entry.entities, entry.tabular_path))
+        elif(file_of_files is None):
+            top_dirs = None
+            if(self.world_size is not None):
+                # Subjects are known from the top-level directory names; only this shard's directories are walked
+                top_dirs = self._own_subject_dirs(root_dir)
+            if(crawl_threads is not None):
+                candidates = crawl(root_dir, num_threads=crawl_threads, find_tabular=find_tabular,
+                                   top_dirs=top_dirs)
+            else:
+                walk_roots = [root_dir] if top_dirs is None else [os.path.join(root_dir, d) for d in top_dirs]
+                for walk_root in walk_roots:
+                    for dirpath, _, files in os.walk(walk_root):
+                        for f in files:
+                            # Select only images
+                            if(is_image(f)):
+                                ent_dict = self._entity_splitter(f)
+                                tabular_path = None
+                                if(find_tabular):
+                                    # get directory
+                                    sub_name = ent_dict['sub']
+                                    sub_dir = dirpath.split('sub-' + sub_name)[0]
+                                    sub_dir = os.path.join(sub_dir, f'sub-{sub_name}')
+                                    for s in os.listdir(sub_dir):
+                                        if(s.endswith('.csv')):
+                                            tabular_path = os.path.join(sub_dir, s)
+                                candidates.append((f, os.path.join(dirpath, f), ent_dict, tabular_path))
         else:
             # load from file
             f = open(file_of_files, 'r')
             files = f.read().splitlines()
             f.close()
-            for fil in files:
-                if(fil.endswith('.nii.gz') or fil.endswith('nii')):
-                    split = fil.split(os.sep)
-                    self.file_list.append(split[-1])
-                    self.file_path_dict[split[-1]] = fil
-                    if(tabular_to_fetch is not None):
-                        ent_dict = self._entity_splitter(fil)
-                        sub_name = ent_dict['sub']
-                        sub_dir = fil.split(sub_name)[0]
-                        for s in os.listdir(sub_dir):
-                            if (s.endswith('.csv')):
-                                self.tabular_path_dict[f] = os.path.join(sub_dir, s)
-
-
-        if verbose: print(f'Found {len(self.file_list)} files')
+            if(self.world_size is not None):
+                counts = dd(int)
+                subjects = [subject_of(fil) for fil in files]
+                for sub in subjects:
+                    counts[sub] += 1
+                own = self._own_shard(counts)
+                files = [fil for fil, sub in zip(files, subjects) if sub in own]
+            candidates = parse_file_list(files, find_tabular=find_tabular)
+
+        # Select files with the columnar entity table; all conditions in a dict must match
+        table = EntityTable([c[2] for c in candidates])
+        if(entities_to_match is None):
+            keep = np.arange(len(candidates))
+        else:
+            keep = table.query(entities_to_match)
+        self.group_dict = None
+        if(group_by is not None):
+            groups = table.take(keep).groups(group_by, members=group_members, member_entity=group_entity)
+            self.group_dict = {}
+            for group in groups:
+                rows = [keep[j] for j in group]
+                for i in rows:
+                    self.file_path_dict[candidates[i][0]] = candidates[i][1]
+                self.group_dict[candidates[rows[0]][0]] = tuple(candidates[i][0] for i in rows)
+            # The first member stands for the group
+            keep = np.array([keep[g[0]] for g in groups], dtype=int)
+        self.entities = table.take(keep)
+        for i in keep:
+            name, path, ent_dict, tabular_path = candidates[i]
+            self.file_list.append(name)
+            self.file_path_dict[name] = path
+            if(self.tabular_path_dict is not None and tabular_path is not None):
+                self.tabular_path_dict[name] = tabular_path
+            if(self.tabular_key_dict is not None):
+                self.tabular_key_dict[name] = tuple(ent_dict.get(e, '') for e in self.tabular_key.values())
+
+        # Read each tabular file once; __getitem__ then serves rows from memory
+        self.tabular_cache = None
+        if(self.tabular_key_dict is not None):
+            self.tabular_cache = PhenotypeStore.open(tabular_store, columns=tabular_to_fetch,
+                                                     key_columns=list(self.tabular_key))
+        elif(tabular_to_fetch is not None):
+            self.tabular_cache = TabularCache.open(self.tabular_path_dict.values(), tabular_to_fetch,
+                                                   cache_file=tabular_cache)
+        if(self.tabular_cache is not None):
+            keys = self.tabular_key_dict if self.tabular_key_dict is not None else self.tabular_path_dict
+            missing = [f for f in self.file_list if keys.get(f) is None or keys[f] not in self.tabular_cache]
+            if(len(missing) > 0):
+                warnings.warn(f'{len(missing)} of {len(self.file_list)} files have no tabular data (e.g. {missing[0]}'
+                              f'{", key " + str(keys.get(missing[0])) if self.tabular_key_dict is not None else ""}); '
+                              f'their tabular data is an empty list')
+
+        if verbose:
+            if(self.group_dict is None):
+                print(f'Found {len(self.file_list)} files')
+            else:
+                print(f'Found {len(self.file_list)} groups of {len(next(iter(self.group_dict.values()), ()))} files')
+
+    def _own_shard(self, weights: dict) -> set:
+        '''
+        Splits subjects between ranks by weight and returns the subjects of this rank.
+        '''
+        self.shard_subjects = assign_shards(weights, self.world_size)[self.rank]
+        return set(self.shard_subjects)
+
+    def _own_subject_dirs(self, root_dir: str) -> list:
+        '''
+        Splits the subject directories of root_dir between ranks by number and returns those of this rank.
+        '''
+        top_dirs = subject_dirs(root_dir)
+        own = self._own_shard({subject_dir_key(d): 1 for d in top_dirs})
+        return [d for d in top_dirs if subject_dir_key(d) in own]
+
+    @classmethod
+    def from_index(cls, index_file: str, **kwargs):
+        '''
+        Opens a dataset directly from a saved index, without accessing the data directory.
+        Parameters
+        ----------
+        index_file : str
+            Path of an index file written by index.DatasetIndex.save() (e.g. by a previous QuickBIDS with index_file).
+        kwargs
+            Other arguments passed to QuickBIDS.
+        Returns
+        -------
+        QuickBIDS
+        '''
+        kwargs.setdefault('refresh_index', False)
+        return cls(index_file=index_file, **kwargs)
+
+    def query(self, conditions) -> np.ndarray:
+        '''
+        Selects dataset entries by their entities, without rescanning the data.
+        Parameters
+        ----------
+        conditions : dict or list
+            Entity conditions; see entities.EntityTable.query.
+        Returns
+        -------
+        np.ndarray
+            Indices of the matching entries, usable with subset() or torch.utils.data.Subset.
+        '''
+        return self.entities.query(conditions)
+
+    def subset(self, indices) -> 'QuickBIDS':
+        '''
+        Returns a new dataset restricted to the entries at indices. File lists are copied; everything else is shared.
+        Parameters
+        ----------
+        indices : array-like
+            Indices of the entries to keep, e.g. as returned by query().
+        Returns
+        -------
+        QuickBIDS
+        '''
+        indices = np.asarray(indices, dtype=int)
+        new = copy.copy(self)
+        new.file_list = [self.file_list[i] for i in indices]
+        names = new.file_list
+        if(self.group_dict is not None):
+            new.group_dict = {f: self.group_dict[f] for f in new.file_list}
+            names = [m for f in new.file_list for m in self.group_dict[f]]
+        new.file_path_dict = dd(str, {f: self.file_path_dict[f] for f in names})
+        if(self.tabular_path_dict is not None):
+            new.tabular_path_dict = dd(str, {f: self.tabular_path_dict[f] for f in new.file_list
+                                             if f in self.tabular_path_dict})
+        if(self.tabular_key_dict is not None):
+            new.tabular_key_dict = {f: self.tabular_key_dict[f] for f in new.file_list}
+        new.entities = self.entities.take(indices)
+        return new
 
     def __len__(self):
         return len(self.file_list)
@@ -116,18 +389,72 @@ class QuickBIDS(Dataset):
         Returns
         -------
         torch.Tensor
-            Imaging data placed on device specified at initialization
+            Imaging data placed on device specified at initialization (CPU in DataLoader workers). With group_by, the
+            members of the group stacked as channels.
         dict
             Dictionary containing tabular
         '''
         file = self.file_list[idx]
-        file_path = self.file_path_dict[file]
 
-        dat = T.Tensor(nb.load(file_path).get_fdata())
+        with self.profiler.stage('sample'):
+            dat = self._load_sample(file)
+            return self._finish(file, dat)
+
+    def get_patch(self, idx, slices):
+        '''
+        Loads a region of an image, reading as little of the file as possible: uncompressed .nii files and
+        uncompressed volume caches only read the requested hyperslab, compressed volume caches only decompress the
+        chunks that overlap it. .nii.gz files without a volume cache are decompressed up to the end of the region.
+        Preprocessing, device placement and tabular data are handled as in __getitem__.
+        Parameters
+        ----------
+        idx : int
+            Index of entry in file_list to load
+        slices : tuple
+            Tuple of slice (step 1), one per leading axis of the image. With group_by, the region is read from every
+            member (slices do not include the channel axis).
+        Returns
+        -------
+        See __getitem__.
+        '''
+        file = self.file_list[idx]
+        slices = tuple(slices)
+        ndim = len(self.volume_shape(idx))
+        with self.profiler.stage('patch'):
+            if(self.group_dict is None):
+                dat = self._read_region(self.file_path_dict[file], slices, ndim)
+            else:
+                dat = self._stack_members(file, lambda path: self._read_region(path, slices, ndim))
+            return self._finish(file, dat)
+
+    def volume_shape(self, idx) -> tuple:
+        '''
+        Returns the shape of an image, read from its header (the data is not loaded).
+        Parameters
+        ----------
+        idx : int
+            Index of entry in file_list
+        Returns
+        -------
+        tuple
+            Shape of the image data (with group_by, of one member, without the channel axis).
+        '''
+        file = self.file_list[idx]
+        if(file not in self._shapes):
+            self._shapes[file] = tuple(nb.load(self.file_path_dict[file]).shape)
+        return self._shapes[file]
+
+    def _finish(self, file: str, dat: T.Tensor):
+        '''
+        Preprocesses loaded data, places it on the device and attaches tabular data.
+        '''
         if(self.preprocess_list is not None):
             for p in self.preprocess_list:
-                dat = p(dat)
-        dat = dat.to(self.device)
+                with self.profiler.stage(f'preprocess {getattr(p, "__name__", type(p).__name__)}'):
+                    dat = p(dat)
+        if(self.device is not None and get_worker_info() is None):
+            with self.profiler.stage('to_device'):
+                dat = dat.to(self.device)
 
         ############
         ### If you need a different return, (e.g., different return), modify this next section
@@ -135,37 +462,100 @@ class QuickBIDS(Dataset):
         # get tabular data, as applicable
         if(self.tabular_to_fetch is None):
             return dat
+        elif(self.tabular_key_dict is not None):
+            with self.profiler.stage('tabular'):
+                tab_dat = self.tabular_cache.records(self.tabular_key_dict.get(file))
+            return dat, tab_dat
         else:
-            tabular_path = self.tabular_path_dict[file]
-            tab_dat = pd.read_csv(tabular_path, usecols=self.tabular_to_fetch).to_dict(orient='records')
+            with self.profiler.stage('tabular'):
+                tab_dat = self.tabular_cache.records(self.tabular_path_dict.get(file))
             return dat, tab_dat
 
-    @staticmethod
-    def _entity_splitter(filename: str,
-                         entity_delim: str = '_',
-                         keyval_delim: str = '-') -> dict:
+    def _load_sample(self, file: str) -> T.Tensor:
         '''
-        Splits the input BIDS-compliant filename into its separate entities.
-        Parameters
-        ----------
-        filename : str
-            Filename to split
-        entity_delim : str
-            Delimiter between entities.  (in "sub-1234_ses-2", the underscore "_" is the entity delim)
-        keyval_delim : str
-            Delimiter between key-value pairs. (in "sub-1234_ses-2", the dash "-" is the keyval delim)
-        Returns
-        -------
-        dict
-            Dictionary with the found entities, and 'suffix' for the last entity (if unkeyed)
-        '''
-        spl = filename.split(entity_delim)
-        entity_dict = dd(str)
-        for ind, s in enumerate(spl):
-            if(keyval_delim in s):
-                k, v = s.split(keyval_delim)
-                entity_dict[k] = v
-            elif(ind == len(spl)-1):
-                entity_dict['suffix'] = s.split('.')[0]
-                entity_dict['extension'] = '.'.join(s.split('.')[1:])
-        return entity_dict
\ No newline at end of file
+        Loads the image of a dataset entry, or the stacked members of its group.
+        '''
+        if(self.group_dict is None):
+            return self._load_volume(self.file_path_dict[file])
+        return self._stack_members(file, self._load_volume)
+
+    def _stack_members(self, file: str, load) -> T.Tensor:
+        '''
+        Calls load(path) on every member of the group of file, concurrently, and stacks the results as channels.
+        '''
+        paths = [self.file_path_dict[m] for m in self.group_dict[file]]
+        # Reads (and decompression) release the GIL
+        with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+            members = list(pool.map(load, paths))
+        dtype = members[0].dtype
+        for m, path in zip(members[1:], paths[1:]):
+            if(m.shape != members[0].shape):
+                raise ValueError(f'{path} has shape {tuple(m.shape)}, but {paths[0]} has shape '
+                                 f'{tuple(members[0].shape)}; members of a group must have the same shape')
+            dtype = T.promote_types(dtype, m.dtype)
+        # One copy (and conversion) per member, straight into its channel
+        dat = T.empty((len(members),) + tuple(members[0].shape), dtype=dtype)
+        for c, m in enumerate(members):
+            dat[c].copy_(m)
+        return dat
+
+    def _load_volume(self, file_path: str) -> T.Tensor:
+        '''
+        Loads image data from file_path, through the shared and volume caches if there are any.
+        '''
+        if(self.shared_cache is not None):
+            with self.profiler.stage('shared_cache get'):
+                dat = self.shared_cache.get(file_path)
+            if(dat is not None):
+                return dat
+        dtype = self._output_dtype(file_path)
+        if(self.volume_cache is None):
+            dat = load_volume(file_path, memmap=self.memmap, profiler=self.profiler, dtype=dtype)
+        else:
+            with self.profiler.stage('volume_cache'):
+                dat = self.volume_cache.load(file_path, dtype=dtype)
+            if(not self.memmap and dtype is None):
+                with self.profiler.stage('convert'):
+                    dat = dat.float()
+        if(self.shared_cache is not None):
+            with self.profiler.stage('shared_cache put'):
+                self.shared_cache.put(file_path, dat)
+        return dat
+
+    def _read_region(self, file_path: str, slices: tuple, ndim: int) -> T.Tensor:
+        '''
+        Reads the region slices of the image at file_path (ndim dimensions), with the same dtype rules as _load_volume.
+        '''
+        dtype = self._output_dtype(file_path)
+        if(self.volume_cache is not None):
+            if(len(slices) == ndim):
+                arr, header = self.volume_cache.read(file_path, last_axis=slices[-1])
+                slices = slices[:-1]
+            else:
+                arr, header = self.volume_cache.read(file_path)
+            # Copying the view only touches the pages of the region
+            dat = scale_tensor(array_to_tensor(np.array(arr[slices])), header['slope'], header['inter'], dtype=dtype)
+        else:
+            proxy = nb.load(file_path, mmap='c').dataobj
+            dat = array_to_tensor(np.ascontiguousarray(proxy[slices]))
+            if(dat.dtype == T.float64):
+                # nibabel applied scaling in float64
+                dat = dat.float()
+            if(dtype is not None):
+                dat = scale_tensor(dat, 1, 0, dtype=dtype)
+        if(not self.memmap and dtype is None):
+            dat = dat.float()
+        return dat
+
+    def _output_dtype(self, file_path: str):
+        '''
+        Returns the output dtype of the image at file_path (from dtypes), or None.
+        '''
+        if(self.dtypes is None):
+            return None
+        if(file_path not in self._dtype_cache):
+            suffix = entity_splitter(os.path.basename(file_path))['suffix']
+            self._dtype_cache[file_path] = self.dtypes.get(suffix, self.dtypes.get('default'))
+        return self._dtype_cache[file_path]
+
+    _entity_splitter = staticmethod(entity_splitter)
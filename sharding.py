@@ -0,0 +1,134 @@
+import heapq
+import numpy as np
+import os
+import torch as T
+from torch.utils.data import Sampler
+
+
+def get_rank_info(rank: int = None, world_size: int = None):
+    '''
+    Returns (rank, world_size), taking undefined values from torch.distributed if it is initialized.
+    '''
+    if(rank is None or world_size is None):
+        if(not (T.distributed.is_available() and T.distributed.is_initialized())):
+            raise ValueError('rank and world_size must be defined when torch.distributed is not initialized.')
+        rank = T.distributed.get_rank() if rank is None else rank
+        world_size = T.distributed.get_world_size() if world_size is None else world_size
+    if(not 0 <= rank < world_size):
+        raise ValueError(f'rank = {rank} is not in [0, {world_size})')
+    return rank, world_size
+
+
+def assign_shards(weights: dict, world_size: int) -> list:
+    '''
+    Splits keys (e.g. subjects) between world_size shards so that the total weight (e.g. bytes) of the shards is
+    balanced, using the greedy longest-processing-time rule: keys are taken by decreasing weight and each goes to the
+    lightest shard. The result only depends on weights, so every rank computes the same assignment.
+    Parameters
+    ----------
+    weights : dict
+        Mapping of key to weight.
+    world_size : int
+        Number of shards.
+    Returns
+    -------
+    list
+        List of world_size lists of keys.
+    '''
+    shards = [[] for _ in range(world_size)]
+    # (total weight, shard) heap; ties go to the lowest shard
+    heap = [(0, r) for r in range(world_size)]
+    for key in sorted(weights, key=lambda k: (-weights[k], str(k))):
+        total, r = heapq.heappop(heap)
+        shards[r].append(key)
+        heapq.heappush(heap, (total + weights[key], r))
+    return shards
+
+
+def subject_of(path: str) -> str:
+    '''
+    Returns the subject label of an image path (the 'sub' entity of its file name), or '' if it has none. Only scans
+    for the entity, so that every rank can label a long file list cheaply; see entities.entity_splitter for full
+    parsing.
+    '''
+    name = os.path.basename(path)
+    if(name.startswith('sub-')):
+        start = 4
+    else:
+        start = name.find('_sub-')
+        if(start < 0):
+            return ''
+        start += 5
+    end = name.find('_', start)
+    return name[start:] if end < 0 else name[start:end]
+
+
+def subject_dir_key(name: str) -> str:
+    '''
+    Returns the subject label of a subject directory name ("sub-<label>").
+    '''
+    return name[4:] if name.startswith('sub-') else name
+
+
+def subject_dirs(root_dir: str) -> list:
+    '''
+    Returns the sorted names of the subject directories ("sub-*") directly in root_dir. Other directories (e.g.
+    derivatives/) are not subjects and are left out.
+    '''
+    with os.scandir(root_dir) as it:
+        return sorted(d.name for d in it if d.is_dir() and d.name.startswith('sub-'))
+
+
+def draw_order_seed() -> int:
+    '''
+    Draws a random seed for the order of unseeded epochs. Draw it in __init__ of an iterable dataset: every DataLoader
+    worker then gets a copy of the same seed, so that workers agree on the order before taking their share of it.
+    '''
+    return int(np.random.SeedSequence().entropy % (1 << 63))
+
+
+class ShardSampler(Sampler):
+    def __init__(self, data_source, shuffle: bool = True, seed: int = 0, num_samples: int = None, rank: int = None):
+        '''
+        Deterministic sampler over a rank's shard of a dataset (e.g. QuickBIDS with rank and world_size): the order of
+        every epoch only depends on seed, epoch and rank. Call set_epoch() at the start of every epoch.
+        Parameters
+        ----------
+        data_source : Dataset
+            Dataset to sample from.
+        shuffle : bool
+            Optional. Whether to shuffle the indices every epoch.
+        seed : int
+            Optional. Seed of the shuffling; must be the same on every rank.
+        num_samples : int
+            Optional. Number of indices per epoch. Shards rarely hold exactly the same number of images; set this to
+            the same value on every rank (e.g. the smallest shard length) so that ranks run the same number of steps.
+            The order is truncated, or repeated from the start. Defaults to len(data_source).
+        rank : int
+            Optional. Rank, mixed into the seed. Defaults to data_source.rank, or 0.
+        '''
+        self.data_source = data_source
+        self.shuffle = shuffle
+        self.seed = seed
+        self.num_samples = num_samples
+        self.rank = rank if rank is not None else (getattr(data_source, 'rank', None) or 0)
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        '''
+        Sets the epoch, so that indices are reshuffled every epoch.
+        '''
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples if self.num_samples is not None else len(self.data_source)
+
+    def __iter__(self):
+        n = len(self.data_source)
+        if(self.shuffle):
+            indices = np.random.default_rng([self.seed, self.epoch, self.rank]).permutation(n)
+        else:
+            indices = np.arange(n)
+        if(self.num_samples is not None and n > 0):
+            indices = np.resize(indices, self.num_samples)
+        return iter(indices.tolist())
@@ -0,0 +1,190 @@
+import multiprocessing as mp
+import time
+import uuid
+import numpy as np
+import torch as T
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+# Prefix of the shared memory blocks (visible in /dev/shm on Linux)
+SHM_PREFIX = 'ndl_'
+POLICIES = ['lru', 'lfu']
+
+
+def _attach(name: str) -> SharedMemory:
+    '''
+    Attaches to an existing block without registering it with this process' resource tracker, which would otherwise
+    destroy it when the process (e.g. a DataLoader worker) exits.
+    '''
+    shm = SharedMemory(name=name)
+    _untrack(shm)
+    return shm
+
+
+def _untrack(shm: SharedMemory):
+    try:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+    except Exception:
+        pass
+
+
+def _unlink(shm: SharedMemory):
+    '''
+    Destroys an untracked block. SharedMemory.unlink also unregisters the block, so register it first to keep the
+    resource tracker consistent.
+    '''
+    resource_tracker.register(shm._name, 'shared_memory')
+    shm.unlink()
+
+
+class SharedVolumeCache:
+    def __init__(self, max_bytes: int, policy: str = 'lru'):
+        '''
+        Cache of decoded image data in shared memory, shared by every DataLoader worker of a dataset: a volume decoded
+        by one worker is served to all the others from a single copy. Must be created in the main process, before the
+        DataLoader starts its workers. Entries are evicted when the total size would exceed max_bytes.
+        Call close() when done; blocks are otherwise left in shared memory until the machine reboots (they are named
+        SHM_PREFIX*, and can be removed from /dev/shm by hand on Linux).
+        Parameters
+        ----------
+        max_bytes : int
+            Maximum total size of the cached data.
+        policy : str
+            Optional. Eviction policy: 'lru' (least recently used) or 'lfu' (least frequently used).
+        '''
+        if(policy not in POLICIES):
+            raise NotImplementedError(f'policy = {policy} has not been implemented')
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._manager = mp.Manager()
+        # key -> (block name, dtype, shape, nbytes)
+        self._index = self._manager.dict()
+        # key -> last access time (lru) or number of accesses (lfu)
+        self._usage = self._manager.dict()
+        self._stats = self._manager.dict(hits=0, misses=0, evictions=0, bytes=0)
+        self._lock = self._manager.Lock()
+
+    def __getstate__(self):
+        # The manager itself stays in the main process; workers only need the proxies
+        state = self.__dict__.copy()
+        state['_manager'] = None
+        return state
+
+    def get(self, key: str):
+        '''
+        Returns a copy of the cached Tensor for key, or None if it is not cached.
+        '''
+        with self._lock:
+            entry = self._index.get(key)
+            if(entry is None):
+                self._stats['misses'] += 1
+                return None
+            self._stats['hits'] += 1
+            if(self.policy == 'lru'):
+                self._usage[key] = time.monotonic_ns()
+            else:
+                self._usage[key] = self._usage.get(key, 0) + 1
+            name, dtype, shape, _ = entry
+            # Attach while holding the lock, so that the block cannot be evicted in between
+            try:
+                shm = _attach(name)
+            except FileNotFoundError:
+                return None
+        try:
+            arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+            dat = T.from_numpy(arr.copy())
+            del arr
+        finally:
+            shm.close()
+        return dat
+
+    def put(self, key: str, dat: T.Tensor) -> bool:
+        '''
+        Adds dat to the cache under key, evicting other entries if needed.
+        Parameters
+        ----------
+        key : str
+            Key of the entry (e.g. the image path).
+        dat : Tensor
+            Data to cache. Tensors whose dtype NumPy cannot represent (e.g. bfloat16) are not cached.
+        Returns
+        -------
+        bool
+            Whether dat was added.
+        '''
+        try:
+            arr = np.ascontiguousarray(dat.detach().cpu().numpy())
+        except TypeError:
+            return False
+        if(arr.nbytes > self.max_bytes or key in self._index):
+            return False
+        # Copy outside of the lock; only the bookkeeping is serialized
+        shm = SharedMemory(name=SHM_PREFIX + uuid.uuid4().hex, create=True, size=max(arr.nbytes, 1))
+        _untrack(shm)
+        np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+        with self._lock:
+            if(key in self._index):
+                added = False
+            else:
+                self._evict(self.max_bytes - arr.nbytes)
+                self._index[key] = (shm.name, arr.dtype.str, arr.shape, arr.nbytes)
+                self._usage[key] = time.monotonic_ns() if self.policy == 'lru' else 1
+                self._stats['bytes'] += arr.nbytes
+                added = True
+        shm.close()
+        if(not added):
+            _unlink(shm)
+        return added
+
+    def _evict(self, max_bytes: int):
+        '''
+        Removes entries until the cache holds at most max_bytes. The lock must be held.
+        '''
+        total = self._stats['bytes']
+        if(total <= max_bytes):
+            return
+        usage = dict(self._usage)
+        index = dict(self._index)
+        n_evicted = 0
+        for key in sorted(usage, key=usage.get):
+            if(total <= max_bytes):
+                break
+            name, _, _, nbytes = index[key]
+            del self._index[key]
+            del self._usage[key]
+            try:
+                shm = _attach(name)
+                shm.close()
+                _unlink(shm)
+            except FileNotFoundError:
+                pass
+            total -= nbytes
+            n_evicted += 1
+        self._stats['bytes'] = total
+        self._stats['evictions'] += n_evicted
+
+    def stats(self) -> dict:
+        '''
+        Returns the cache counters: hits, misses, evictions, bytes and entries.
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._index)
+        return stats
+
+    def clear(self):
+        '''
+        Removes every entry.
+        '''
+        with self._lock:
+            self._evict(0)
+
+    def close(self):
+        '''
+        Removes every entry and stops the manager process. Must be called from the process that created the cache.
+        '''
+        if(self._manager is None):
+            return
+        self.clear()
+        self._manager.shutdown()
+        self._manager = None
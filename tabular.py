@@ -0,0 +1,235 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Column identifying the file each row was read from
+SOURCE_COLUMN = '_tabular_path'
+
+
+def _key_strings(column: pd.Series) -> pd.Series:
+    '''
+    Converts a key column to str. Integral floats (e.g. integer columns stored as float64) lose their '.0', so that
+    they match entity values.
+    '''
+    if(pd.api.types.is_float_dtype(column)):
+        values = column.dropna()
+        if((values == np.floor(values)).all()):
+            return column.astype('Int64').astype(str)
+    return column.astype(str)
+
+
+class TabularCache:
+    def __init__(self, frame: pd.DataFrame):
+        '''
+        In-memory table holding the rows of many small tabular files, with an index from source file to its rows.
+        Parameters
+        ----------
+        frame : pd.DataFrame
+            Concatenated rows, with the source file of each row in SOURCE_COLUMN. Rows of a source must be contiguous.
+        '''
+        self.frame = frame.reset_index(drop=True)
+        self.columns = [c for c in self.frame.columns if c != SOURCE_COLUMN]
+        # Plain arrays: slicing these is much cheaper than going through the DataFrame on every lookup
+        self._arrays = [self.frame[c].to_numpy() for c in self.columns]
+        sources = self.frame[SOURCE_COLUMN].to_numpy()
+        self._rows = {}
+        if(len(sources) > 0):
+            bounds = np.flatnonzero(sources[1:] != sources[:-1]) + 1
+            starts = np.concatenate([[0], bounds])
+            stops = np.concatenate([bounds, [len(sources)]])
+            for start, stop in zip(starts, stops):
+                self._rows[sources[start]] = (int(start), int(stop))
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __contains__(self, tabular_path):
+        return tabular_path in self._rows
+
+    def records(self, tabular_path: str) -> list:
+        '''
+        Returns the rows of tabular_path, in the same format as pd.read_csv(...).to_dict(orient='records').
+        Parameters
+        ----------
+        tabular_path : str
+            Source file.
+        Returns
+        -------
+        list
+            List of dict, one per row. Empty if tabular_path is not in the cache.
+        '''
+        start, stop = self._rows.get(tabular_path, (0, 0))
+        values = [a[start:stop].tolist() for a in self._arrays]
+        return [dict(zip(self.columns, row)) for row in zip(*values)]
+
+    @classmethod
+    def from_files(cls, tabular_paths, columns: list):
+        '''
+        Reads every tabular file once and consolidates the rows. Text columns with repeated values are stored as
+        categoricals.
+        Parameters
+        ----------
+        tabular_paths : iterable
+            Paths of the tabular files. Duplicates are read only once.
+        columns : list
+            Columns to read from each file.
+        Returns
+        -------
+        TabularCache
+        '''
+        frames = []
+        for tabular_path in dict.fromkeys(tabular_paths):
+            df = pd.read_csv(tabular_path, usecols=columns)
+            df[SOURCE_COLUMN] = tabular_path
+            frames.append(df)
+        if(len(frames) == 0):
+            return cls(pd.DataFrame(columns=list(columns) + [SOURCE_COLUMN]))
+        frame = pd.concat(frames, ignore_index=True)[list(columns) + [SOURCE_COLUMN]]
+        for c in frame.columns:
+            if(pd.api.types.is_string_dtype(frame[c]) and frame[c].nunique() < len(frame) // 2):
+                frame[c] = frame[c].astype('category')
+        return cls(frame)
+
+    def save(self, cache_file: str):
+        '''
+        Writes the cache to a Parquet (.parquet) or Feather (any other extension) file. Requires pyarrow.
+        Parameters
+        ----------
+        cache_file : str
+            Path of the file to write.
+        '''
+        tmp_file = f'{cache_file}.{os.getpid()}.tmp'
+        if(cache_file.endswith('.parquet')):
+            self.frame.to_parquet(tmp_file, index=False)
+        else:
+            self.frame.to_feather(tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    @classmethod
+    def load(cls, cache_file: str, columns: list = None):
+        '''
+        Reads a cache written by save().
+        Parameters
+        ----------
+        cache_file : str
+            Path of the file.
+        columns : list
+            Optional. Columns to read. Defaults to all.
+        Returns
+        -------
+        TabularCache
+        '''
+        if(columns is not None):
+            columns = list(columns) + [SOURCE_COLUMN]
+        if(cache_file.endswith('.parquet')):
+            frame = pd.read_parquet(cache_file, columns=columns)
+        else:
+            frame = pd.read_feather(cache_file, columns=columns)
+        return cls(frame)
+
+    @classmethod
+    def open(cls, tabular_paths, columns: list, cache_file: str = None):
+        '''
+        Loads the cache from cache_file if it holds the requested columns for every file in tabular_paths; otherwise
+        reads the tabular files and, if cache_file is defined, saves the result there.
+        The cache is not checked against the modification time of the tabular files; delete cache_file after editing
+        them.
+        Parameters
+        ----------
+        tabular_paths : iterable
+            Paths of the tabular files.
+        columns : list
+            Columns to read.
+        cache_file : str
+            Optional. Parquet/Feather file to load from or save to.
+        Returns
+        -------
+        TabularCache
+        '''
+        tabular_paths = list(tabular_paths)
+        if(cache_file is not None and os.path.isfile(cache_file)):
+            try:
+                cache = cls.load(cache_file, columns=columns)
+            except (KeyError, ValueError):
+                # Requested columns are missing from the saved cache
+                cache = None
+            if(cache is not None and all(p in cache for p in tabular_paths)):
+                return cache
+        cache = cls.from_files(tabular_paths, columns)
+        if(cache_file is not None):
+            cache.save(cache_file)
+        return cache
+
+
+class PhenotypeStore:
+    def __init__(self, frame: pd.DataFrame, key_columns: list):
+        '''
+        In-memory table of a consolidated phenotype store (see utilities.csv_to_store), with an index from key (e.g.
+        subject, or subject and session) to its rows.
+        Parameters
+        ----------
+        frame : pd.DataFrame
+            Rows of the store, including key_columns.
+        key_columns : list
+            Columns identifying the rows of an image. Keys are compared as str (e.g. an integer eid 1234 matches the
+            subject entity '1234').
+        '''
+        self.frame = frame.reset_index(drop=True)
+        self.key_columns = list(key_columns)
+        self.columns = [c for c in self.frame.columns if c not in self.key_columns]
+        self._arrays = [self.frame[c].to_numpy() for c in self.columns]
+        self._rows = {}
+        if(len(self.frame) > 0):
+            keys = pd.DataFrame({i: _key_strings(self.frame[c]) for i, c in enumerate(self.key_columns)})
+            for key, rows in keys.groupby(list(keys.columns), sort=False).indices.items():
+                self._rows[key if isinstance(key, tuple) else (key,)] = rows
+
+    def __len__(self):
+        return len(self.frame)
+
+    def __contains__(self, key):
+        return tuple(key) in self._rows
+
+    def records(self, key: tuple) -> list:
+        '''
+        Returns the rows of key, in the same format as TabularCache.records.
+        Parameters
+        ----------
+        key : tuple
+            Values of the key columns, as str.
+        Returns
+        -------
+        list
+            List of dict, one per row. Empty if key is not in the store.
+        '''
+        rows = self._rows.get(tuple(key)) if key is not None else None
+        if(rows is None):
+            return []
+        values = [a[rows].tolist() for a in self._arrays]
+        return [dict(zip(self.columns, row)) for row in zip(*values)]
+
+    @classmethod
+    def open(cls, store_file: str, columns: list = None, key_columns: list = ('eid',)):
+        '''
+        Reads a store, loading only the requested columns.
+        Parameters
+        ----------
+        store_file : str
+            Parquet (.parquet) or Feather (any other extension) file written by utilities.csv_to_store. Requires
+            pyarrow.
+        columns : list
+            Optional. Columns to read. Defaults to all.
+        key_columns : list
+            Optional. Columns identifying the rows of an image.
+        Returns
+        -------
+        PhenotypeStore
+        '''
+        key_columns = list(key_columns)
+        if(columns is not None):
+            columns = key_columns + [c for c in columns if c not in key_columns]
+        if(store_file.endswith('.parquet')):
+            frame = pd.read_parquet(store_file, columns=columns)
+        else:
+            frame = pd.read_feather(store_file, columns=columns)
+        return cls(frame, key_columns)
@@ -1 +1,2 @@
-from . import transform
\ No newline at end of file
+from . import transform
+from . import pipeline
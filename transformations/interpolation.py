@@ -1,107 +1,198 @@
 import torch as T
 
-def interp_nearest(data, sample_locations, border_mode='zero'):
+# Default number of sample points evaluated at once; bounds the size of temporary index/weight tensors
+DEFAULT_CHUNK_SIZE = 1 << 22
+BORDER_MODES = ['zero', 'nearest', 'reflect']
+
+
+def interp_nearest(data, sample_locations, border_mode='zero', chunk_size=DEFAULT_CHUNK_SIZE):
     '''
     Performs nearest-neighbour interpolation
     Parameters
     ----------
     data : Tensor
-        data from which to sample
+        data from which to sample. The last ndim dimensions are spatial (ndim = sample_locations.shape[0]); any leading
+        dimensions (e.g. channels) are sampled at the same locations.
     sample_locations : Tensor
-        locations to sample
+        locations to sample, [ndim x sample_points...], in voxel coordinates.
     border_mode : str
-        How to handle out-of-border data.
+        How to handle out-of-border data. Valid values: ['zero', 'nearest', 'reflect']
+    chunk_size : int
+        Optional. Number of sample points evaluated at once. None evaluates all points at once.
     Returns
     -------
     Tensor
-        Interpolated data.
+        Interpolated data, [leading dimensions x sample_points...], same dtype as data.
     '''
-    # data: X x Y x Z
-    # sample_locations: [ndim x sample_points]
-    ndim = len(data.shape)
-    # voxel coordinates from which to sample
-    sample_nn = T.round(sample_locations).long()
-    device = data.device
-    # exceeds image limits?
-    #print(time() - start)
-    out_of_bounds_0 = T.stack([sample_nn[i, ...] >= T.Tensor([data.shape[i]]).long().to(device) for i in range(ndim)], dim=0)
-    out_of_bounds_1 = T.stack([sample_nn[i, ...] < T.zeros(1).long().to(device) for i in range(ndim)], dim=0)
-    #print(time() - start)
-    out_of_bounds = out_of_bounds_0 + out_of_bounds_1
-    out_of_bounds = out_of_bounds != 0
-    sample_nn[out_of_bounds] = 0
-    #print(time() - start)
-    #sample_nn[out_of_bounds.expand(ndim, -1)] = 0
-
-    # this generalizes well to N dimensions, but takes 120x as long (~24s) in the typical 3d case
-    # TODO: Use sub2ind to get around tuple indexing
-    # tuple_ind = [tuple(sample_nn[i, ...]) for i in range(ndim)]
-    # new_image = data[tuple_ind]
-
-    # works fast, but assumes 3D data
-    new_image = data[sample_nn[0,...], sample_nn[1,...], sample_nn[2,...]]
-
-    #print(time() - start)
-    if(border_mode == 'zero'):
-        new_image[out_of_bounds[0,...]] = 0
-    else:
-        raise NotImplementedError(f'border_mode = {border_mode} has not been implemented')
-    return new_image.view(*sample_locations.shape[1:])
+    base, lead_offsets, spatial_shape, strides, locations = _prepare(data, sample_locations, border_mode)
+    out = T.empty((lead_offsets.shape[0], locations.shape[1]), dtype=data.dtype, device=data.device)
+    for start, stop in _chunks(locations.shape[1], chunk_size):
+        loc = _apply_border(locations[:, start:stop], spatial_shape, border_mode)
+        # voxel coordinates from which to sample
+        sample_nn = T.round(loc).long()
+        ind, valid = _sub2ind(sample_nn, spatial_shape, strides)
+        vals = _gather(base, lead_offsets, ind)
+        if(border_mode == 'zero'):
+            vals[:, ~valid] = 0
+        out[:, start:stop] = vals
+    return out.view(*data.shape[:-len(spatial_shape)], *sample_locations.shape[1:])
 
 
-def interp_linear(data, sample_locations, border_mode='zero'):
+def interp_linear(data, sample_locations, border_mode='zero', chunk_size=DEFAULT_CHUNK_SIZE, dtype=None):
     '''
     Performs linear interpolation.
     Parameters
     ----------
     data : Tensor
-        data from which to sample
+        data from which to sample. The last ndim dimensions are spatial (ndim = sample_locations.shape[0]); any leading
+        dimensions (e.g. channels) are sampled at the same locations.
     sample_locations : Tensor
-        locations to sample
+        locations to sample, [ndim x sample_points...], in voxel coordinates.
     border_mode : str
-        How to handle out-of-border data.
+        How to handle out-of-border data. Valid values: ['zero', 'nearest', 'reflect']. With 'zero', data is treated
+        as 0 outside of the volume, so values fade out over the last voxel.
+    chunk_size : int
+        Optional. Number of sample points evaluated at once. None evaluates all points at once.
+    dtype : torch.dtype
+        Optional. Output dtype. Defaults to data's dtype if it is floating point, float32 otherwise. Integer outputs
+        are rounded one chunk at a time, so no full-size float volume is allocated.
     Returns
     -------
     Tensor
-        Interpolated data.
+        Interpolated data, [leading dimensions x sample_points...].
     '''
     # At every sample location, get surrounding 2^ndim points in data and take weighted mean
-    device = data.device
-    data_pad = T.zeros((data.shape[0]+2, data.shape[1]+2, data.shape[2]+2), device=device)
-    data_pad[1:-1, 1:-1, 1:-1] = data
-    ndim = len(data.shape)
-    sample_shape = sample_locations.shape
-    sample_reshape = (sample_locations + T.ones(sample_shape, device=device)).view(3, -1)
-
-    # voxel coordinates from which to sample
-    #sample_nn = T.round(sample_locations).long()
-    # print('data_shape: ' + str(data.shape))
-    # Assume 3d
-    fx = sample_reshape[0,:] - T.floor(sample_reshape[0,:])
-    fy = sample_reshape[1, :] - T.floor(sample_reshape[1, :])
-    fz = sample_reshape[2, :] - T.floor(sample_reshape[2, :])
-    im = T.zeros(sample_reshape.shape[1], device=device)
-    # im = T.zeros((5,5,5))
-    for z_ind in range(2):
-        fz = 1-fz
-        z_func = T.floor if z_ind == 0 else T.ceil
-        for y_ind in range(2):
-            fy = 1-fy
-            y_func = T.floor if y_ind == 0 else T.ceil
-            for x_ind in range(2):
-                fx = 1-fx
-                x_func = T.floor if x_ind == 0 else T.ceil
-                x_indices = T.clamp( x_func(sample_reshape[0,:]), 0, data.shape[0]-1).long()
-                y_indices = T.clamp( y_func(sample_reshape[1,:]), 0, data.shape[1]-1).long()
-                z_indices = T.clamp( z_func(sample_reshape[2,:]), 0, data.shape[2]-1).long()
-                im += fz*fy*fx * data_pad[x_indices, y_indices, z_indices]
-
-    return im.view(*sample_shape[1:])
-# def _sub2ind(subs, dat_shape):
-#     ndim = subs.shape[0]
-#
-#     shp = [1]
-#     shp += [i for i in dat_shape[:0:-1]]
-#     shp = T.cumprod(T.Tensor(shp),0)
-#
-#     return T.matmul(shp, subs)
+    base, lead_offsets, spatial_shape, strides, locations = _prepare(data, sample_locations, border_mode)
+    ndim = len(spatial_shape)
+    out_dtype = dtype if dtype is not None else (data.dtype if data.is_floating_point() else T.float32)
+    round_out = not out_dtype.is_floating_point
+    # Coordinates and weights need at least single precision, even for half-precision data
+    compute_dtype = T.float64 if data.dtype == T.float64 else T.float32
+    out = T.empty((lead_offsets.shape[0], locations.shape[1]), dtype=out_dtype, device=data.device)
+    for start, stop in _chunks(locations.shape[1], chunk_size):
+        loc = _apply_border(locations[:, start:stop], spatial_shape, border_mode).to(compute_dtype)
+        lower = T.floor(loc)
+        frac = loc - lower
+        lower = lower.long()
+        # Per-dimension index offsets and weights of the lower (0) and upper (1) corner, computed once
+        offsets = []
+        weights = []
+        for d in range(ndim):
+            corner_offsets = []
+            corner_weights = []
+            for c in range(2):
+                sub = lower[d] + c
+                weight = frac[d] if c == 1 else 1 - frac[d]
+                valid = (sub >= 0) & (sub < spatial_shape[d])
+                # Out-of-bounds corners contribute nothing ('nearest'/'reflect' only hit these with zero weight)
+                weight = T.where(valid, weight, T.zeros_like(weight))
+                corner_offsets.append(T.clamp(sub, 0, spatial_shape[d] - 1) * strides[d])
+                corner_weights.append(weight)
+            offsets.append(corner_offsets)
+            weights.append(corner_weights)
+
+        acc = T.zeros((lead_offsets.shape[0], stop - start), dtype=compute_dtype, device=data.device)
+        for corner in range(2 ** ndim):
+            ind = offsets[0][corner & 1]
+            w = weights[0][corner & 1]
+            for d in range(1, ndim):
+                bit = (corner >> d) & 1
+                ind = ind + offsets[d][bit]
+                w = w * weights[d][bit]
+            acc.addcmul_(w.unsqueeze(0), _gather(base, lead_offsets, ind).to(compute_dtype))
+        out[:, start:stop] = acc.round_() if round_out else acc
+    return out.view(*data.shape[:-ndim], *sample_locations.shape[1:])
+
+
+def _prepare(data, sample_locations, border_mode):
+    '''
+    Validates inputs and returns a flat view of data's memory, so that any voxel can be gathered with a single linear
+    index whatever the memory layout of data (e.g. Fortran-ordered NIfTI data is not copied).
+    Returns
+    -------
+    Tensor
+        1D view of the memory spanned by data.
+    Tensor
+        Offset of every entry of the leading (non-spatial) dimensions, flattened.
+    tuple
+        Spatial shape.
+    list
+        Strides of the spatial dimensions.
+    Tensor
+        Sample locations, [ndim x points].
+    '''
+    if(border_mode not in BORDER_MODES):
+        raise NotImplementedError(f'border_mode = {border_mode} has not been implemented')
+    ndim = sample_locations.shape[0]
+    if(data.dim() < ndim):
+        raise ValueError(f'data has {data.dim()} dimensions; sample_locations requires at least {ndim}')
+    n_lead = data.dim() - ndim
+    spatial_shape = tuple(data.shape[n_lead:])
+    strides = list(data.stride()[n_lead:])
+    span = 1 + sum((n - 1) * st for n, st in zip(data.shape, data.stride())) if data.numel() > 0 else 0
+    base = data.as_strided((span,), (1,))
+    lead_offsets = T.zeros(1, dtype=T.long, device=data.device)
+    for n, st in zip(data.shape[:n_lead], data.stride()[:n_lead]):
+        lead_offsets = (lead_offsets[:, None] + T.arange(n, device=data.device)[None, :] * st).view(-1)
+    locations = sample_locations.reshape(ndim, -1).to(data.device)
+    return base, lead_offsets, spatial_shape, strides, locations
+
+
+def _gather(base, lead_offsets, ind):
+    '''
+    Gathers [leading x points] values at flat spatial indices ind.
+    '''
+    if(lead_offsets.shape[0] == 1):
+        return base[ind + lead_offsets[0]].unsqueeze(0)
+    return base[lead_offsets[:, None] + ind[None, :]]
+
+
+def _chunks(n, chunk_size):
+    '''
+    Yields (start, stop) ranges covering n points.
+    '''
+    if(chunk_size is None or chunk_size <= 0):
+        chunk_size = max(n, 1)
+    for start in range(0, n, chunk_size):
+        yield start, min(start + chunk_size, n)
+
+
+def _apply_border(loc, spatial_shape, border_mode):
+    '''
+    Maps continuous coordinates into the volume for the 'nearest' (clamp) and 'reflect' border modes.
+    '''
+    if(border_mode == 'zero'):
+        return loc
+    loc = loc.float() if not loc.is_floating_point() else loc
+    out = T.empty_like(loc)
+    for d, n in enumerate(spatial_shape):
+        if(n == 1):
+            out[d] = 0
+        elif(border_mode == 'nearest'):
+            out[d] = T.clamp(loc[d], 0, n - 1)
+        else:
+            # Reflection about the first and last voxel centres; period 2(n-1)
+            period = 2 * (n - 1)
+            r = T.remainder(loc[d], period)
+            out[d] = T.where(r > n - 1, period - r, r)
+    return out
+
+
+def _sub2ind(subs, dat_shape, strides):
+    '''
+    Converts [ndim x points] integer subscripts to flat indices into an array of shape dat_shape with the given
+    strides.
+    Returns
+    -------
+    Tensor
+        Flat indices; out-of-bounds subscripts are mapped to 0.
+    Tensor
+        Boolean mask of in-bounds subscripts.
+    '''
+    ind = T.zeros(subs.shape[1], dtype=T.long, device=subs.device)
+    valid = T.ones(subs.shape[1], dtype=T.bool, device=subs.device)
+    for d, n in enumerate(dat_shape):
+        valid &= (subs[d] >= 0) & (subs[d] < n)
+        ind += subs[d] * strides[d]
+    ind[~valid] = 0
+    return ind, valid
@@ -9,18 +9,10 @@ def affine_2d(translation=None, rotation=0, scale=None, shear=None):
     if shear is None:
         shear=[0,0]
 
-    transf = T.zeros((3,3))
-    c = T.cos(T.Tensor([rotation]))
-    s = T.sin(T.Tensor([rotation]))
-    # rotation
-    transf[:2, :2] = T.Tensor([[c, -s],[s, c]])
-    # scaling
-    transf[:2, :2] = T.matmul(T.Tensor([[scale[0], 0],[0, scale[1]]]), transf[:2, :2])
-    # shearing
-    transf[:2, :2] = T.matmul(T.Tensor([[1, shear[0]],[shear[1], 1]]), transf[:2, :2])
-
-    transf[:, -1] = T.Tensor([*translation, 1])
-    return transf
+    return affine_2d_batch(translation=T.as_tensor(translation, dtype=T.float32).view(1, 2),
+                           rotation=T.as_tensor(rotation, dtype=T.float32).view(1),
+                           scale=T.as_tensor(scale, dtype=T.float32).view(1, 2),
+                           shear=T.as_tensor(shear, dtype=T.float32).view(1, 2))[0]
 
 def affine_3d(translation=None, rotation=None, scale=None, shear=None):
     '''
@@ -54,40 +46,8 @@ def affine_3d(translation=None, rotation=None, scale=None, shear=None):
         scale = T.ones((3,1))
     if shear is None:
         shear = [[0,0],[0,0],[0,0]]
-    transf = T.zeros((4,4))
-    rc = T.cos(rotation)
-    rs = T.sin(rotation)
-
-    # rotation
-    rot_x = T.Tensor([[1,0,0],[0, rc[0], -rs[0]], [0, rs[0], rc[0]]])
-    rot_y = T.Tensor([[rc[1], 0, rs[1]],[0,1,0], [-rs[1], 0, rc[1]]])
-    rot_z = T.Tensor([[rc[2], -rs[2],0], [rs[2], rc[2], 0], [0,0,1]])
-    transf[:3, :3] = T.matmul( rot_z, T.matmul(rot_y, rot_x))
-
-    # scale
-    scal = T.zeros((3,3))
-    scal[0,0] = scale[0]
-    scal[1,1] = scale[1]
-    scal[2,2] = scale[2]
-    transf[:3,:3] = T.matmul(scal, transf[:3,:3])
-
-    # shear
-    shx = T.eye(3)
-    shx[0,1] = shear[0][0]
-    shx[0,2] = shear[0][1]
-
-    shy =T.eye(3)
-    shy[1,0] = shear[1][0]
-    shy[1,2] = shear[1][1]
-
-    shz = T.eye(3)
-    shz[2,0] = shear[2][0]
-    shz[2,1] = shear[2][1]
-    sh = T.matmul(shz, T.matmul(shy, shx))
-
-    transf[:3, :3] = T.matmul(sh, transf[:3,:3])
-    transf[:, -1] = T.Tensor([*translation, 1])
-    return transf
+    return affine_3d_batch(translation=_as_batch(translation, 3), rotation=_as_batch(rotation, 3),
+                           scale=_as_batch(scale, 3), shear=_as_batch(shear, 6))[0]
 
 def random_affine_3d(translation_limits=None, rotation_limits=None, scale_limits=None,
                      shear_limits=None, return_param=False):
@@ -138,4 +98,263 @@ def random_affine_3d(translation_limits=None, rotation_limits=None, scale_limits
     if return_param:
         return translation, rotation, scale, shear
     else:
-        return affine_3d(translation=translation, rotation=rotation, scale=scale, shear=shear)
\ No newline at end of file
+        return affine_3d(translation=translation, rotation=rotation, scale=scale, shear=shear)
+
+
+def _as_batch(param, n: int) -> T.Tensor:
+    '''
+    Converts a single set of parameters (list or Tensor of any shape with n entries) to a (1, n) float Tensor.
+    '''
+    if(isinstance(param, T.Tensor)):
+        return param.detach().float().reshape(1, n)
+    return T.as_tensor([float(v) for v in _flatten(param)], dtype=T.float32).view(1, n)
+
+
+def _flatten(param):
+    for v in param:
+        if(isinstance(v, (list, tuple)) or (isinstance(v, T.Tensor) and v.dim() > 0)):
+            yield from _flatten(v)
+        else:
+            yield v
+
+
+def _uniform(batch_size: int, limits: T.Tensor, generator: T.Generator = None, device=None) -> T.Tensor:
+    '''
+    Samples (batch_size, n) values uniformly within n (min, max) limits.
+    '''
+    limits = limits.to(device=device, dtype=T.float32)
+    u = T.rand((batch_size, limits.shape[0]), generator=generator, device=device)
+    return u * (limits[:, 1] - limits[:, 0]) + limits[:, 0]
+
+
+def affine_2d_batch(translation: T.Tensor = None, rotation: T.Tensor = None, scale: T.Tensor = None,
+                    shear: T.Tensor = None, batch_size: int = None, device=None) -> T.Tensor:
+    '''
+    Generates a batch of 2D affine matrices (Bx3x3). Same composition as affine_2d:
+        Sh * Scale * R
+    Parameters
+    ----------
+    translation : Tensor
+        Optional. Bx2 Tensor of X,Y translations in voxels. Defaults to 0.
+    rotation : Tensor
+        Optional. B Tensor of rotations. Defaults to 0.
+    scale : Tensor
+        Optional. Bx2 Tensor of X,Y scales. Defaults to 1.
+    shear : Tensor
+        Optional. Bx2 Tensor of shears [Sh_xy, Sh_yx]. Defaults to 0.
+    batch_size : int
+        Optional. Batch size, if no parameter is defined.
+    device : str
+        Optional. Device of the matrices. Defaults to the device of the parameters.
+    Returns
+    -------
+    Tensor
+        Bx3x3 Tensor
+    '''
+    batch_size, device = _batch_info([translation, rotation, scale, shear], batch_size, device)
+    if(rotation is None):
+        rotation = T.zeros(batch_size, device=device)
+    if(scale is None):
+        scale = T.ones((batch_size, 2), device=device)
+    c = T.cos(rotation.to(device))
+    s = T.sin(rotation.to(device))
+    sx, sy = scale.to(device).unbind(1)
+    # Scale * R, then shear
+    rs = T.stack([T.stack([sx * c, -sx * s], dim=1),
+                  T.stack([sy * s, sy * c], dim=1)], dim=1)
+    transf = T.zeros((batch_size, 3, 3), device=device)
+    if(shear is None):
+        transf[:, :2, :2] = rs
+    else:
+        sh = T.eye(2, device=device).repeat(batch_size, 1, 1)
+        sh[:, 0, 1] = shear[:, 0].to(device)
+        sh[:, 1, 0] = shear[:, 1].to(device)
+        transf[:, :2, :2] = T.matmul(sh, rs)
+    if(translation is not None):
+        transf[:, :2, 2] = translation.to(device)
+    transf[:, 2, 2] = 1
+    return transf
+
+
+def affine_3d_batch(translation: T.Tensor = None, rotation: T.Tensor = None, scale: T.Tensor = None,
+                    shear: T.Tensor = None, batch_size: int = None, device=None) -> T.Tensor:
+    '''
+    Generates a batch of 3D affine matrices (Bx4x4) with batched operations. Same composition as affine_3d:
+        Shz * Shy * Shx * Scale * Rz * Ry * Rx
+    Parameters
+    ----------
+    translation : Tensor
+        Optional. Bx3 Tensor of X,Y,Z translations in voxels. Defaults to 0.
+    rotation : Tensor
+        Optional. Bx3 Tensor of rotations along X,Y,Z axes. Defaults to 0.
+    scale : Tensor
+        Optional. Bx3 Tensor of scales along X,Y,Z axes. Defaults to 1.
+    shear : Tensor
+        Optional. Bx6 (or Bx3x2) Tensor of shears [Sh_xy, Sh_xz, Sh_yx, Sh_yz, Sh_zx, Sh_zy]. Defaults to 0.
+    batch_size : int
+        Optional. Batch size, if no parameter is defined.
+    device : str
+        Optional. Device of the matrices. Defaults to the device of the parameters.
+    Returns
+    -------
+    Tensor
+        Bx4x4 Tensor
+    '''
+    batch_size, device = _batch_info([translation, rotation, scale, shear], batch_size, device)
+    transf = T.zeros((batch_size, 4, 4), device=device)
+    if(rotation is None):
+        rot = T.eye(3, device=device).repeat(batch_size, 1, 1)
+    else:
+        cx, cy, cz = T.cos(rotation.to(device)).unbind(1)
+        sx, sy, sz = T.sin(rotation.to(device)).unbind(1)
+        # Rz * Ry * Rx, expanded
+        rot = T.stack([T.stack([cz * cy, cz * sy * sx - sz * cx, cz * sy * cx + sz * sx], dim=1),
+                       T.stack([sz * cy, sz * sy * sx + cz * cx, sz * sy * cx - cz * sx], dim=1),
+                       T.stack([-sy, cy * sx, cy * cx], dim=1)], dim=1)
+    if(scale is not None):
+        rot = rot * scale.to(device).unsqueeze(2)
+    if(shear is not None):
+        shear = shear.to(device).reshape(batch_size, 6)
+        one = T.ones(batch_size, device=device)
+        zero = T.zeros(batch_size, device=device)
+        # Shz * Shy * Shx, expanded
+        a, b, c, d, e, f = shear.unbind(1)
+        sh = T.stack([T.stack([one, a, b], dim=1),
+                      T.stack([c, c * a + 1, c * b + d], dim=1),
+                      T.stack([e + f * c, e * a + f * (c * a + 1), e * b + f * (c * b + d) + 1], dim=1)], dim=1)
+        rot = T.matmul(sh, rot)
+    transf[:, :3, :3] = rot
+    if(translation is not None):
+        transf[:, :3, 3] = translation.to(device)
+    transf[:, 3, 3] = 1
+    return transf
+
+
+def _batch_info(params: list, batch_size: int = None, device=None):
+    '''
+    Infers the batch size and device from the first defined parameter.
+    '''
+    for p in params:
+        if(p is not None):
+            if(batch_size is None):
+                batch_size = p.shape[0]
+            if(device is None):
+                device = p.device
+            break
+    if(batch_size is None):
+        raise ValueError('batch_size must be defined if no parameter is')
+    if(device is None):
+        device = 'cpu'
+    return batch_size, device
+
+
+def random_affine_3d_batch(batch_size: int, translation_limits=None, rotation_limits=None, scale_limits=None,
+                           shear_limits=None, generator: T.Generator = None, seed: int = None, device=None,
+                           return_param=False):
+    '''
+    Generates a batch of random affine matrices. All parameters are sampled at once, and matrices are composed with
+    batched operations on device.
+    Parameters
+    ----------
+    batch_size : int
+        Number of matrices.
+    translation_limits : Tensor
+        Optional. 3x2 Tensor specifying (min, max) translations in X,Y,Z directions. Defaults to 0.
+    rotation_limits : Tensor
+        Optional. 3x2 Tensor specifying (min, max) rotations along X,Y,Z axes. Defaults to 0.
+    scale_limits : Tensor
+        Optional. 3x2 Tensor specifying (min, max) scaling along X,Y,Z directions. Defaults to 1.
+    shear_limits : Tensor
+        Optional. 6x2 Tensor specifying (min, max) for xy, xz, yx, yz, zx, zy. Defaults to 0.
+    generator : torch.Generator
+        Optional. Random number generator (on device). Takes precedence over seed.
+    seed : int
+        Optional. Seed of a new generator, for reproducible matrices.
+    device : str
+        Optional. Device on which parameters are sampled and matrices are composed. Defaults to CPU.
+    return_param : bool
+        If True, also returns the sampled parameters.
+    Returns
+    -------
+    Tensor
+        Bx4x4 affine matrices.
+    tuple
+        Only if return_param. (translation Bx3, rotation Bx3, scale Bx3, shear Bx3x2)
+    '''
+    if(device is None):
+        device = 'cpu' if generator is None else generator.device
+    if(generator is None and seed is not None):
+        generator = T.Generator(device=device)
+        generator.manual_seed(seed)
+    if translation_limits is None:
+        translation_limits = T.zeros((3,2))
+    if rotation_limits is None:
+        rotation_limits = T.zeros((3,2))
+    if(scale_limits is None):
+        scale_limits = T.ones((3,2))
+    if(shear_limits is None):
+        shear_limits = T.zeros((6,2))
+
+    limits = T.cat([translation_limits, rotation_limits, scale_limits, shear_limits], dim=0)
+    params = _uniform(batch_size, limits, generator=generator, device=device)
+    translation, rotation, scale, shear = T.split(params, [3, 3, 3, 6], dim=1)
+    mats = affine_3d_batch(translation=translation, rotation=rotation, scale=scale, shear=shear)
+    if return_param:
+        return mats, (translation, rotation, scale, shear.reshape(batch_size, 3, 2))
+    return mats
+
+
+def random_affine_2d_batch(batch_size: int, translation_limits=None, rotation_limits=None, scale_limits=None,
+                           shear_limits=None, generator: T.Generator = None, seed: int = None, device=None,
+                           return_param=False):
+    '''
+    Generates a batch of random 2D affine matrices; see random_affine_3d_batch.
+    Parameters
+    ----------
+    batch_size : int
+        Number of matrices.
+    translation_limits : Tensor
+        Optional. 2x2 Tensor specifying (min, max) translations in X,Y directions. Defaults to 0.
+    rotation_limits : Tensor
+        Optional. 1x2 Tensor specifying (min, max) rotation. Defaults to 0.
+    scale_limits : Tensor
+        Optional. 2x2 Tensor specifying (min, max) scaling along X,Y directions. Defaults to 1.
+    shear_limits : Tensor
+        Optional. 2x2 Tensor specifying (min, max) for xy, yx. Defaults to 0.
+    generator : torch.Generator
+        Optional. Random number generator (on device). Takes precedence over seed.
+    seed : int
+        Optional. Seed of a new generator, for reproducible matrices.
+    device : str
+        Optional. Device on which parameters are sampled and matrices are composed. Defaults to CPU.
+    return_param : bool
+        If True, also returns the sampled parameters.
+    Returns
+    -------
+    Tensor
+        Bx3x3 affine matrices.
+    tuple
+        Only if return_param. (translation Bx2, rotation B, scale Bx2, shear Bx2)
+    '''
+    if(device is None):
+        device = 'cpu' if generator is None else generator.device
+    if(generator is None and seed is not None):
+        generator = T.Generator(device=device)
+        generator.manual_seed(seed)
+    if translation_limits is None:
+        translation_limits = T.zeros((2,2))
+    if rotation_limits is None:
+        rotation_limits = T.zeros((1,2))
+    if(scale_limits is None):
+        scale_limits = T.ones((2,2))
+    if(shear_limits is None):
+        shear_limits = T.zeros((2,2))
+
+    limits = T.cat([translation_limits, rotation_limits.view(1, 2), scale_limits, shear_limits], dim=0)
+    params = _uniform(batch_size, limits, generator=generator, device=device)
+    translation, rotation, scale, shear = T.split(params, [2, 1, 2, 2], dim=1)
+    rotation = rotation.view(batch_size)
+    mats = affine_2d_batch(translation=translation, rotation=rotation, scale=scale, shear=shear)
+    if return_param:
+        return mats, (translation, rotation, scale, shear)
+    return mats
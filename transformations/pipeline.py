@@ -0,0 +1,280 @@
+import torch as T
+from torch.utils.data import get_worker_info
+from . import matrices
+from . import transform
+
+
+class Affine:
+    # Resampling steps are the expensive ones; Pipeline.split() moves them to the device
+    heavy = True
+
+    def __init__(self, mat_affine: T.Tensor, interpolation: str = 'nearest', border_mode: str = 'zero'):
+        '''
+        Fixed affine transformation step; see transform.affine.
+        Parameters
+        ----------
+        mat_affine : Tensor
+            4x4 (or 3x3 for 2D data) affine matrix, e.g. from matrices.affine_3d.
+        interpolation : str or list
+            Optional. Valid values: ['nearest', 'linear'], or a list of one per channel (see transform.affine_batch).
+        border_mode : str
+            Optional. Valid values: ['zero', 'nearest', 'reflect']
+        '''
+        self.mat_affine = mat_affine
+        self.interpolation = interpolation
+        self.border_mode = border_mode
+
+    def matrices(self, batch_size: int, device) -> T.Tensor:
+        '''
+        Returns the (batch_size, ndim+1, ndim+1) matrices of the step.
+        '''
+        return self.mat_affine.to(device=device, dtype=T.float64).expand(batch_size, -1, -1)
+
+    def __call__(self, dat: T.Tensor) -> T.Tensor:
+        return _FusedAffine([self])(dat)
+
+
+class RandomAffine:
+    heavy = True
+
+    def __init__(self, translation_limits: T.Tensor = None, rotation_limits: T.Tensor = None,
+                 scale_limits: T.Tensor = None, shear_limits: T.Tensor = None, ndim: int = 3,
+                 interpolation: str = 'nearest', border_mode: str = 'zero', generator: T.Generator = None):
+        '''
+        Random affine transformation step: a new matrix is drawn for every image (every image of a batch, in batched
+        mode). Limits are as in matrices.random_affine_3d_batch (or random_affine_2d_batch if ndim is 2).
+        Parameters
+        ----------
+        translation_limits : Tensor
+            Optional. ndim x 2 Tensor of (min, max) translations.
+        rotation_limits : Tensor
+            Optional. 3x2 (1x2 in 2D) Tensor of (min, max) rotations.
+        scale_limits : Tensor
+            Optional. ndim x 2 Tensor of (min, max) scaling.
+        shear_limits : Tensor
+            Optional. 6x2 (2x2 in 2D) Tensor of (min, max) shears.
+        ndim : int
+            Optional. Number of spatial dimensions: 3 or 2.
+        interpolation : str or list
+            Optional. Valid values: ['nearest', 'linear'], or a list of one per channel (see transform.affine_batch).
+        border_mode : str
+            Optional. Valid values: ['zero', 'nearest', 'reflect']
+        generator : torch.Generator
+            Optional. Random number generator, for reproducible transformations. In DataLoader workers, which all get a
+            copy of it in the same state, it is re-seeded from its seed and the worker's seed (get_worker_info().seed),
+            so that workers draw different matrices; seed torch (or the DataLoader's generator) to reproduce them.
+        '''
+        if(ndim not in [2, 3]):
+            raise ValueError(f'ndim = {ndim} is not supported')
+        self.translation_limits = translation_limits
+        self.rotation_limits = rotation_limits
+        self.scale_limits = scale_limits
+        self.shear_limits = shear_limits
+        self.ndim = ndim
+        self.interpolation = interpolation
+        self.border_mode = border_mode
+        self.generator = generator
+        self._seed = generator.initial_seed() if generator is not None else None
+        self._worker_seed = None
+
+    def matrices(self, batch_size: int, device) -> T.Tensor:
+        '''
+        Draws (batch_size, ndim+1, ndim+1) matrices.
+        '''
+        worker_info = get_worker_info()
+        if(self.generator is not None and worker_info is not None and self._worker_seed != worker_info.seed):
+            self.generator.manual_seed((self._seed + worker_info.seed) % (1 << 63))
+            self._worker_seed = worker_info.seed
+        random_affine = matrices.random_affine_3d_batch if self.ndim == 3 else matrices.random_affine_2d_batch
+        mats = random_affine(batch_size, translation_limits=self.translation_limits,
+                             rotation_limits=self.rotation_limits, scale_limits=self.scale_limits,
+                             shear_limits=self.shear_limits, generator=self.generator)
+        return mats.to(device=device, dtype=T.float64)
+
+    def __call__(self, dat: T.Tensor) -> T.Tensor:
+        return _FusedAffine([self])(dat)
+
+
+class Normalize:
+    # __call__ and batch take an inplace argument
+    supports_inplace = True
+
+    def __init__(self, mean: float = None, std: float = None, eps: float = 1e-8):
+        '''
+        Intensity normalization step, (dat - mean) / std. Runs in place when the pipeline owns the data.
+        Parameters
+        ----------
+        mean : float
+            Optional. Mean to subtract. Defaults to the mean of each image.
+        std : float
+            Optional. Standard deviation to divide by. Defaults to the standard deviation of each image.
+        eps : float
+            Optional. Added to std, to avoid dividing by 0.
+        '''
+        self.mean = mean
+        self.std = std
+        self.eps = eps
+
+    def __call__(self, dat: T.Tensor, inplace: bool = False) -> T.Tensor:
+        return self._normalize(dat, inplace, dims=None)
+
+    def batch(self, dat: T.Tensor, inplace: bool = False) -> T.Tensor:
+        '''
+        Normalizes each image of a batch with its own statistics.
+        '''
+        return self._normalize(dat, inplace, dims=tuple(range(1, dat.dim())))
+
+    def _normalize(self, dat: T.Tensor, inplace: bool, dims) -> T.Tensor:
+        if(not dat.is_floating_point()):
+            dat = dat.float()
+            inplace = True
+        stats = dat.float() if dat.dtype in [T.float16, T.bfloat16] else dat
+        if(self.mean is not None):
+            mean = self.mean
+        else:
+            mean = stats.mean() if dims is None else stats.mean(dim=dims, keepdim=True)
+        if(self.std is not None):
+            std = self.std
+        else:
+            std = stats.std() if dims is None else stats.std(dim=dims, keepdim=True)
+        std = std + self.eps
+        if(inplace):
+            return dat.sub_(mean).div_(std)
+        return (dat - mean) / std
+
+
+class _FusedAffine:
+    heavy = True
+
+    def __init__(self, steps: list):
+        '''
+        Consecutive affine steps with the same interpolation and border mode, applied as a single resampling with the
+        product of their matrices.
+        '''
+        self.steps = steps
+        self.interpolation = steps[0].interpolation
+        self.border_mode = steps[0].border_mode
+
+    def matrices(self, batch_size: int, device) -> T.Tensor:
+        # Steps apply in order, so the first step's matrix is the rightmost factor
+        mats = self.steps[0].matrices(batch_size, device)
+        for step in self.steps[1:]:
+            mats = T.matmul(step.matrices(batch_size, device), mats)
+        return mats
+
+    def __call__(self, dat: T.Tensor) -> T.Tensor:
+        return self.batch(dat.unsqueeze(0))[0]
+
+    def batch(self, dat: T.Tensor) -> T.Tensor:
+        mats = self.matrices(dat.shape[0], dat.device)
+        return transform.affine_batch(dat, mats, interpolation=self.interpolation, border_mode=self.border_mode)
+
+
+def _fusable(step) -> bool:
+    return isinstance(step, (Affine, RandomAffine))
+
+
+def _fuse(steps: list) -> list:
+    '''
+    Replaces runs of consecutive affine steps that share interpolation and border mode with _FusedAffine stages.
+    '''
+    stages = []
+    for step in steps:
+        if(_fusable(step)):
+            last = stages[-1] if len(stages) > 0 else None
+            if(isinstance(last, _FusedAffine) and last.interpolation == step.interpolation
+               and last.border_mode == step.border_mode):
+                last.steps.append(step)
+            else:
+                stages.append(_FusedAffine([step]))
+        else:
+            stages.append(step)
+    return stages
+
+
+class Pipeline:
+    def __init__(self, steps: list, device: str = None, inplace: bool = False):
+        '''
+        Preprocessing pipeline, usable as QuickBIDS' preprocess_list (alone or in a list). Steps are applied in order.
+        Consecutive Affine / RandomAffine steps with the same interpolation and border mode are fused: their matrices
+        are multiplied and the image is resampled once, which is faster and avoids compounding interpolation blur.
+        Steps with supports_inplace = True (e.g. Normalize) modify data that the pipeline owns (i.e. that an earlier step
+        allocated, or any input if inplace is True) instead of allocating a new Tensor.
+        Any other callable is applied as-is.
+        Parameters
+        ----------
+        steps : list
+            Steps: Affine, RandomAffine, Normalize, or any callable taking and returning a Tensor.
+        device : str
+            Optional. Device to which data is moved before the first step.
+        inplace : bool
+            Optional. If True, the input itself may be modified in place (e.g. freshly loaded images).
+        '''
+        for s in steps:
+            if(not callable(s)):
+                raise ValueError(f'Preprocessing function {s} is not callable')
+        self.steps = list(steps)
+        self.device = device
+        self.inplace = inplace
+        self._stages = _fuse(self.steps)
+
+    def __call__(self, dat: T.Tensor) -> T.Tensor:
+        '''
+        Applies the pipeline to one image, optionally with leading channel dimensions.
+        '''
+        return self._run(dat, batched=False)
+
+    def batch(self, dat: T.Tensor) -> T.Tensor:
+        '''
+        Applies the pipeline to a batch of images (e.g. after collation and transfer to the GPU). Fused affine stages
+        resample the whole batch with one grid_sample call, with a different random matrix per image; steps without a
+        batch method are applied to each image in turn.
+        Parameters
+        ----------
+        dat : Tensor
+            (B, X, Y, Z) or (B, C, X, Y, Z) batch.
+        Returns
+        -------
+        Tensor
+            Processed batch.
+        '''
+        return self._run(dat, batched=True)
+
+    def _run(self, dat: T.Tensor, batched: bool) -> T.Tensor:
+        if(self.device is not None):
+            moved = dat.to(self.device)
+            owned = self.inplace or moved is not dat
+            dat = moved
+        else:
+            owned = self.inplace
+        for stage in self._stages:
+            supports_inplace = getattr(stage, 'supports_inplace', False)
+            kwargs = {'inplace': owned} if supports_inplace else {}
+            if(batched and hasattr(stage, 'batch')):
+                dat = stage.batch(dat, **kwargs)
+            elif(batched):
+                dat = T.stack([stage(d, **kwargs) for d in dat])
+            else:
+                dat = stage(dat, **kwargs)
+            # Resampling, stacking and in-place capable steps return data that nothing else refers to
+            owned = batched or supports_inplace or getattr(stage, 'heavy', False)
+        return dat
+
+    def split(self):
+        '''
+        Splits the pipeline before its first heavy (resampling) step, so that light steps run in the DataLoader
+        workers and heavy ones on the GPU, on whole batches:
+            host, device = Pipeline([...], device='cuda:0').split()
+            dataset = QuickBIDS(..., preprocess_list=host, device=None)
+            for batch in DevicePrefetcher(DataLoader(dataset, pin_memory=True, ...)):
+                batch = device.batch(batch)
+        Returns
+        -------
+        Pipeline
+            Steps before the first heavy step, without a device.
+        Pipeline
+            The remaining steps, on this pipeline's device. It owns its input (collated batches are fresh Tensors).
+        '''
+        first = next((i for i, s in enumerate(self.steps) if getattr(s, 'heavy', False)), len(self.steps))
+        return (Pipeline(self.steps[:first], inplace=self.inplace),
+                Pipeline(self.steps[first:], device=self.device, inplace=True))
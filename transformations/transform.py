@@ -1,5 +1,6 @@
+import threading
 import torch as T
-import numpy as np
+from collections import OrderedDict
 from . import interpolation as interp
 from . import matrices
 
@@ -11,7 +12,8 @@ def affine(dat: T.Tensor, mat_affine: T.Tensor, device: str=None, interpolation:
     Parameters
     ----------
     dat : Tensor
-        Data to be transformed. Expects 3D.
+        Data to be transformed. Expects 3D, optionally with leading (e.g. channel) dimensions that are transformed
+        identically. 2D data is supported with a 3x3 matrix.
     mat_affine : Tensor
         4x4 matrix specifying an affine transformation. Can be generated from parameters using 'matrices.py'
     device : str
@@ -19,7 +21,7 @@ def affine(dat: T.Tensor, mat_affine: T.Tensor, device: str=None, interpolation:
     interpolation : str
         Optional. Type of interpolation to be done (defined in 'interpolation.py'). Valid values: ['nearest', 'linear']
     border_mode : str
-        Optional. Type of border mode. Valid values: ['zero']
+        Optional. Type of border mode. Valid values: ['zero', 'nearest', 'reflect']
 
     Returns
     -------
@@ -28,21 +30,234 @@ def affine(dat: T.Tensor, mat_affine: T.Tensor, device: str=None, interpolation:
     '''
     # Note: 'mat_affine' is more about the _intent_ of this function. We don't verify or enforce affine-ness.
 
-    ndim = len(dat.shape)
+    ndim = mat_affine.shape[-1] - 1
+    shape = tuple(dat.shape[-ndim:])
     if(device is None):
         device = dat.device
-    inv_mat = T.inverse(mat_affine).to(device)
-    midpoint = [T.floor(T.Tensor([i/2])).int() for i in dat.shape]  # origin is at the centre of the image
-    slices = [slice(-midpoint[i], midpoint[i]) for i in range(ndim)]
-    dat_loc = T.from_numpy(np.mgrid[slices]).float().to(device)  # initial grid
-    dat_flat = dat_loc.view(ndim, -1)
-    new_pos = T.matmul(inv_mat, T.cat([dat_flat,T.ones((1, dat_flat.shape[-1])).to(device)], 0))  # sampling grid
-
-    for i in range(ndim):
-        new_pos[i, ...] += midpoint[i].float().to(device)
+    dat = dat.to(device)
+    inv_mat = T.inverse(mat_affine.float()).to(device)
+    # origin is at the centre of the image
+    midpoint = T.tensor([n // 2 for n in shape], dtype=T.float32, device=device).view(ndim, 1)
+    new_pos = T.matmul(inv_mat[:ndim], _base_grid(shape, device, T.float32).t()) + midpoint  # sampling grid
+    new_pos = new_pos.view(ndim, *shape)
+
     if(interpolation == 'nearest'):
-        return interp.interp_nearest(dat, new_pos[:-1,...].view(ndim, *dat_loc.shape[1:]), border_mode=border_mode)
+        return interp.interp_nearest(dat, new_pos, border_mode=border_mode)
     elif(interpolation == 'linear'):
-        return interp.interp_linear(dat, new_pos[:-1,...].view(ndim, *dat_loc.shape[1:]), border_mode=border_mode)
+        return interp.interp_linear(dat, new_pos, border_mode=border_mode)
+    else:
+        raise NotImplementedError(f'interpolation type {interpolation} has not been implemented')
+
+# Translation of border_mode names to grid_sample padding modes
+_PADDING_MODES = {'zero': 'zeros', 'nearest': 'border', 'reflect': 'reflection'}
+# Translation of interpolation names to grid_sample modes
+_SAMPLE_MODES = {'nearest': 'nearest', 'linear': 'bilinear'}
+# Base sampling grids, keyed by (shape, device, dtype), least recently used first. A 256^3 float32 grid takes 256 MB,
+# so only the grids of the last few shapes are kept
+BASE_GRID_CACHE_SIZE = 4
+_base_grids = OrderedDict()
+_base_grids_lock = threading.Lock()
+
+
+def _base_grid(shape: tuple, device, dtype) -> T.Tensor:
+    '''
+    Returns the homogeneous voxel coordinates of a grid of the given shape, with the origin at the centre of the image
+    (as in affine). The BASE_GRID_CACHE_SIZE most recently used grids are cached, per shape, device and dtype.
+    Parameters
+    ----------
+    shape : tuple
+        Spatial shape of the grid.
+    device : str
+        Device of the grid.
+    dtype : torch.dtype
+        Floating point type of the grid.
+    Returns
+    -------
+    Tensor
+        (N, ndim+1) Tensor, where N is the number of voxels.
+    '''
+    key = (tuple(shape), str(device), dtype)
+    with _base_grids_lock:
+        grid = _base_grids.get(key)
+        if(grid is not None):
+            _base_grids.move_to_end(key)
+            return grid
+    ndim = len(shape)
+    axes = [(T.arange(n, device=device, dtype=dtype) - (n // 2)).view([-1 if i == d else 1 for i in range(ndim)])
+            for d, n in enumerate(shape)]
+    grid = T.stack([a.expand(*shape) for a in axes], dim=-1).view(-1, ndim)
+    grid = T.cat([grid, T.ones((grid.shape[0], 1), device=device, dtype=dtype)], dim=1)
+    with _base_grids_lock:
+        _base_grids[key] = grid
+        while(len(_base_grids) > BASE_GRID_CACHE_SIZE):
+            _base_grids.popitem(last=False)
+    return grid
+
+
+def sampling_grid(shape: tuple, mat_affine: T.Tensor, device=None, dtype=T.float32) -> T.Tensor:
+    '''
+    Computes the grid_sample sampling grids of a batch of affine transformations with a single batched matmul.
+    Uses the same conventions as affine: voxel units, origin at the centre of the image, mat_affine maps input to
+    output positions.
+    Parameters
+    ----------
+    shape : tuple
+        Spatial shape of the images, e.g. (X, Y, Z).
+    mat_affine : Tensor
+        (B, ndim+1, ndim+1) Tensor of affine matrices.
+    device : str
+        Optional. Device of the grid. Defaults to the device of mat_affine.
+    dtype : torch.dtype
+        Optional. Floating point type of the grid.
+    Returns
+    -------
+    Tensor
+        (B, *shape, ndim) grid of normalized coordinates (align_corners=True), last dimension in grid_sample order
+        (reversed axes).
+    '''
+    ndim = len(shape)
+    if(device is None):
+        device = mat_affine.device
+    inv_mat = T.inverse(mat_affine.to(device=device, dtype=T.float64))[:, :ndim, :]
+    # Fold the midpoint offset and the voxel -> [-1, 1] normalization into the matrices
+    inv_mat[:, :, -1] += T.tensor([n // 2 for n in shape], device=device, dtype=T.float64)
+    norm = 2 / T.tensor([max(n - 1, 1) for n in shape], device=device, dtype=T.float64)
+    inv_mat = inv_mat * norm.view(1, ndim, 1)
+    inv_mat[:, :, -1] -= 1
+    # grid_sample expects coordinates in reversed axis order (x indexes the last dimension)
+    inv_mat = T.flip(inv_mat, dims=[1]).to(dtype)
+    grid = T.matmul(_base_grid(shape, device, dtype), inv_mat.transpose(1, 2))
+    return grid.view(mat_affine.shape[0], *shape, ndim)
+
+
+def affine_batch(dat: T.Tensor, mat_affine: T.Tensor, device: str=None, interpolation: str='nearest',
+                 border_mode: str='zero'):
+    '''
+    Applies a batch of affine transformations, one per image, with grid_sample. The base grid is cached per shape and
+    device, and the sampling grids of the whole batch are computed with one matmul, so the cost does not grow with a
+    Python loop over the batch.
+    Parameters
+    ----------
+    dat : Tensor
+        Data to be transformed, (B, X, Y, Z) or (B, C, X, Y, Z). 2D data ((B, X, Y) or (B, C, X, Y)) is also supported,
+        with 3x3 matrices.
+    mat_affine : Tensor
+        (B, 4, 4) Tensor of affine matrices (or a single 4x4 matrix applied to every image). Can be generated with
+        matrices.random_affine_3d.
+    device : str
+        Optional. Specifies device to perform transformation. Defaults to the same device that 'dat' is on.
+    interpolation : str or list
+        Optional. Type of interpolation to be done. Valid values: ['nearest', 'linear']. A list gives one type per
+        channel (e.g. linear for images stacked with a nearest-neighbour label map); the sampling grid is computed
+        once and shared by all of them.
+    border_mode : str
+        Optional. Type of border mode. Valid values: ['zero', 'nearest', 'reflect']
+
+    Returns
+    -------
+    Tensor
+        'dat' that has undergone the specified transformations, same shape and dtype as 'dat'. Data that grid_sample
+        cannot handle without a full-volume conversion (integer types, and half precision on the CPU) is resampled
+        with the gather kernels of interpolation.py instead: nearest-neighbour keeps the data type throughout, linear
+        converts one chunk of samples at a time (and rounds it back for integer types) into an output of the same
+        dtype.
+    '''
+    modes = list(interpolation) if isinstance(interpolation, (list, tuple)) else [interpolation]
+    for mode in modes:
+        if(mode not in _SAMPLE_MODES):
+            raise NotImplementedError(f'interpolation type {mode} has not been implemented')
+    if(border_mode not in _PADDING_MODES):
+        raise NotImplementedError(f'border_mode = {border_mode} has not been implemented')
+    if(device is None):
+        device = dat.device
+    if(mat_affine.dim() == 2):
+        mat_affine = mat_affine.unsqueeze(0).expand(dat.shape[0], -1, -1)
+    ndim = mat_affine.shape[-1] - 1
+    has_channels = dat.dim() == ndim + 2
+    inp = dat.to(device)
+    if(not has_channels):
+        inp = inp.unsqueeze(1)
+    if(len(modes) == 1):
+        modes = modes * inp.shape[1]
+    elif(len(modes) != inp.shape[1]):
+        raise ValueError(f'{len(modes)} interpolation types given for {inp.shape[1]} channels')
+    # Channels are resampled in groups sharing an interpolation type (a single group in the usual case)
+    groups = {}
+    for c, mode in enumerate(modes):
+        groups.setdefault(mode, []).append(c)
+    if(not _grid_sample_supports(inp)):
+        out = T.empty_like(inp)
+        # One image at a time, so that only one image's sample locations are held; its channel groups share them
+        for b in range(inp.shape[0]):
+            loc = voxel_locations(inp.shape[2:], mat_affine[b:b + 1], device=device)
+            out[b:b + 1] = _resample_groups(inp[b:b + 1], groups,
+                                            lambda sub, mode: _affine_batch_gather(sub, loc, mode, border_mode))
     else:
-        raise NotImplementedError(f'interpolation type {interpolation} has not been implemented')
\ No newline at end of file
+        grid = sampling_grid(inp.shape[2:], mat_affine, device=device, dtype=inp.dtype)
+        out = _resample_groups(inp, groups, lambda sub, mode: T.nn.functional.grid_sample(
+            sub, grid, mode=_SAMPLE_MODES[mode], padding_mode=_PADDING_MODES[border_mode], align_corners=True))
+    if(not has_channels):
+        out = out.squeeze(1)
+    return out.to(dat.dtype)
+
+
+def _resample_groups(inp: T.Tensor, groups: dict, resample) -> T.Tensor:
+    '''
+    Applies resample(channels, interpolation) to each group of channels of inp (B, C, ...) and reassembles them.
+    '''
+    if(len(groups) == 1):
+        mode, = groups
+        return resample(inp, mode)
+    out = T.empty_like(inp)
+    for mode, channels in groups.items():
+        out[:, channels] = resample(inp[:, channels], mode).to(out.dtype)
+    return out
+
+
+def _grid_sample_supports(dat: T.Tensor) -> bool:
+    '''
+    Returns whether grid_sample can resample dat in its own dtype.
+    '''
+    if(dat.dtype in [T.float32, T.float64]):
+        return True
+    return dat.dtype == T.float16 and dat.is_cuda
+
+
+def voxel_locations(shape: tuple, mat_affine: T.Tensor, device=None) -> T.Tensor:
+    '''
+    Computes the voxel coordinates sampled by a batch of affine transformations (the conventions of affine).
+    Parameters
+    ----------
+    shape : tuple
+        Spatial shape of the images.
+    mat_affine : Tensor
+        (B, ndim+1, ndim+1) Tensor of affine matrices.
+    device : str
+        Optional. Device of the result. Defaults to the device of mat_affine.
+    Returns
+    -------
+    Tensor
+        (B, ndim, *shape) float32 sample locations, as expected by interpolation.interp_nearest / interp_linear.
+    '''
+    ndim = len(shape)
+    if(device is None):
+        device = mat_affine.device
+    inv_mat = T.inverse(mat_affine.to(device=device, dtype=T.float64))[:, :ndim, :]
+    inv_mat[:, :, -1] += T.tensor([n // 2 for n in shape], device=device, dtype=T.float64)
+    loc = T.matmul(inv_mat.float(), _base_grid(shape, device, T.float32).t())
+    return loc.view(mat_affine.shape[0], ndim, *shape)
+
+
+def _affine_batch_gather(dat: T.Tensor, loc: T.Tensor, interpolation: str, border_mode: str) -> T.Tensor:
+    '''
+    affine_batch on (B, C, ...) data with the interpolation.py kernels, one image at a time, at the (B, ndim, ...)
+    sample locations loc (see voxel_locations).
+    '''
+    out = []
+    for b in range(dat.shape[0]):
+        if(interpolation == 'nearest'):
+            res = interp.interp_nearest(dat[b], loc[b], border_mode=border_mode)
+        else:
+            res = interp.interp_linear(dat[b], loc[b], border_mode=border_mode, dtype=dat.dtype)
+        out.append(res)
+    return T.stack(out)
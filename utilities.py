@@ -1,12 +1,13 @@
 import pandas as pd
 import os
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict as dd
 from pathlib import Path
 from string import Formatter
 
 def csv_split(table_file: str, output_template: str, column_key_translate : defaultdict = None, chunksize: int = 1000,
-              include_match: defaultdict = None):
+              include_match: defaultdict = None, vectorized: bool = True, n_jobs: int = 8):
     '''
     Divides a large tabular file into single-entry tables.
     Parameters
@@ -28,6 +29,12 @@ def csv_split(table_file: str, output_template: str, column_key_translate : defa
         Optional. Number of rows of the table to load at a time.
     include_match : defaultdict
         Optional. If defined, only extract rows that match all values.
+    vectorized : bool
+        Optional. If True, each chunk is filtered with boolean masks and formatted to CSV at once, directories are
+        created once, and files are written by a thread pool. Output is the same as the row-by-row mode (False): one
+        file per row, with header; when several rows map to the same file, the last one is kept.
+    n_jobs : int
+        Optional. Number of threads writing files in vectorized mode.
     Returns
     -------
     None
@@ -36,6 +43,8 @@ def csv_split(table_file: str, output_template: str, column_key_translate : defa
     # Define behaviour
     if(column_key_translate is None):
         column_key_translate = dd()
+    if(include_match is None):
+        include_match = {}
 
     # Get data
     csv = pd.read_csv(table_file, chunksize=chunksize, low_memory=False)
@@ -48,6 +57,14 @@ def csv_split(table_file: str, output_template: str, column_key_translate : defa
     else:
         parent_path = ''
 
+    if(vectorized):
+        created_dirs = set()
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            for chunk in csv:
+                _split_chunk(chunk, output_template, parent_path, output_keys, column_key_translate, include_match,
+                             created_dirs, pool)
+        return
+
     # Iterate through csv chunks
     for chunk in csv:
         # Iterate through rows in chunk
@@ -82,3 +99,169 @@ def csv_split(table_file: str, output_template: str, column_key_translate : defa
             row.to_csv(output_name, header=True, index=False)
     return
 
+
+def _split_chunk(chunk: pd.DataFrame, output_template: str, parent_path: str, output_keys: set,
+                 column_key_translate: dict, include_match: dict, created_dirs: set, pool: ThreadPoolExecutor):
+    '''
+    Writes the rows of a chunk to their own files (vectorized mode of csv_split).
+    '''
+    mask = pd.Series(True, index=chunk.index)
+    for k, v in include_match.items():
+        mask &= (chunk[k] == v)
+    chunk = chunk[mask.to_numpy()]
+    if(len(chunk) == 0):
+        return
+
+    # Build output names from whole columns
+    key_values = {k: chunk[column_key_translate.get(k, k)].tolist() for k in output_keys}
+    rows = [{k: key_values[k][i] for k in output_keys} for i in range(len(chunk))]
+    output_names = [output_template.format(**r) for r in rows]
+    # Rows are written in order in the row-by-row mode, so the last row of each file wins
+    last_row = {name: i for i, name in enumerate(output_names)}
+
+    for r in (rows[i] for i in last_row.values()):
+        path_name = parent_path.format(**r)
+        if(path_name not in created_dirs):
+            if(path_name != ''):
+                Path(path_name).mkdir(parents=True, exist_ok=True)
+            created_dirs.add(path_name)
+
+    # Format the chunk once and split it into lines; fall back to per-row formatting if a value spans several lines
+    header = chunk.iloc[:0].to_csv(index=False)
+    lines = chunk.to_csv(header=False, index=False).splitlines(keepends=True)
+    if(len(lines) != len(chunk)):
+        lines = [chunk.iloc[i:i + 1].to_csv(header=False, index=False) for i in range(len(chunk))]
+
+    futures = [pool.submit(_write_text, name, header + lines[i]) for name, i in last_row.items()]
+    for f in futures:
+        f.result()
+
+
+def _write_text(file_name: str, text: str):
+    with open(file_name, 'w', newline='') as f:
+        f.write(text)
+
+
+def csv_to_store(table_file: str, store_file: str, key_columns: list = ('eid',), columns: list = None,
+                 chunksize: int = 10000, include_match: defaultdict = None, dtype: dict = None):
+    '''
+    Converts a large tabular file into a single columnar store (Parquet or Feather), as an alternative to splitting it
+    into per-subject files with csv_split. QuickBIDS reads it with tabular_store, loading only the requested columns.
+    The table is read twice, chunk by chunk, so it never has to fit in memory: a first pass finds a type for every
+    column that holds the values of all chunks (e.g. a sparse column that is empty in the first chunks but holds text
+    later), and the second converts it. Requires pyarrow.
+    Parameters
+    ----------
+    table_file : str
+        Name of the file containing the data.
+    store_file : str
+        Path of the store to write: Parquet if it ends with '.parquet' (one row group per chunk), Feather otherwise.
+    key_columns : list
+        Optional. Columns identifying the rows of an image, e.g. ['eid'] (subject) or ['eid', 'visit'].
+    columns : list
+        Optional. Columns to keep, in addition to key_columns. Defaults to all.
+    chunksize : int
+        Optional. Number of rows of the table to load at a time.
+    include_match : defaultdict
+        Optional. If defined, only keep rows that match all values.
+    dtype : dict
+        Optional. Column types, passed to pd.read_csv. Key columns are otherwise stored as str, so that zero-padded
+        labels (e.g. eid '0001') keep matching the entities of the images. Other types are inferred from the whole
+        table: columns holding any text are stored as strings, integer columns as int64 if they have no missing
+        values (float64 otherwise), other numbers as float64.
+    Returns
+    -------
+    None
+    '''
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError('csv_to_store requires the pyarrow package')
+    key_columns = list(key_columns)
+    if(include_match is None):
+        include_match = {}
+    usecols = None
+    if(columns is not None):
+        usecols = list(dict.fromkeys(key_columns + list(columns) + list(include_match)))
+    dtype = {**_infer_csv_dtypes(table_file, chunksize, usecols, dtype, key_columns), **(dtype or {})}
+    csv = pd.read_csv(table_file, chunksize=chunksize, usecols=usecols, dtype=dtype, low_memory=False)
+
+    tmp_file = f'{store_file}.{os.getpid()}.tmp'
+    writer = None
+    schema = None
+    done = False
+    try:
+        for chunk in csv:
+            mask = pd.Series(True, index=chunk.index)
+            for k, v in include_match.items():
+                mask &= (chunk[k] == v)
+            chunk = chunk[mask.to_numpy()]
+            if(columns is not None):
+                chunk = chunk[list(dict.fromkeys(key_columns + list(columns)))]
+            if(schema is None):
+                schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+                for i, field in enumerate(schema):
+                    if(pa.types.is_null(field.type)):
+                        # Text column without any value in this chunk
+                        schema = schema.set(i, pa.field(field.name, pa.string()))
+                if(store_file.endswith('.parquet')):
+                    writer = pa.parquet.ParquetWriter(tmp_file, schema)
+                else:
+                    writer = pa.ipc.new_file(tmp_file, schema)
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+        if(writer is None):
+            raise ValueError(f'{table_file} has no rows')
+        writer.close()
+        writer = None
+        os.replace(tmp_file, store_file)
+        done = True
+    finally:
+        if(writer is not None):
+            writer.close()
+        if(not done and os.path.exists(tmp_file)):
+            os.remove(tmp_file)
+
+
+def _infer_csv_dtypes(table_file: str, chunksize: int, usecols: list, dtype: dict, key_columns: list) -> dict:
+    '''
+    Reads a table once and returns, for pd.read_csv, a type per column that holds the values of every chunk: str for
+    key columns and if any chunk has text, 'boolean' for True/False columns, int64 for integers without missing values
+    and float64 for other numbers. Columns in dtype are left to it; columns without any value are read as float64.
+    '''
+    kinds = {}
+    has_missing = set()
+    for chunk in pd.read_csv(table_file, chunksize=chunksize, usecols=usecols, dtype=dtype, low_memory=False):
+        for name, col in chunk.items():
+            if(dtype is not None and name in dtype):
+                continue
+            if(name in key_columns):
+                kinds[name] = 'str'
+                continue
+            if(col.isna().any()):
+                has_missing.add(name)
+            if(col.isna().all()):
+                kinds.setdefault(name, None)
+                continue
+            if(pd.api.types.is_bool_dtype(col)):
+                kind = 'bool'
+            elif(pd.api.types.is_integer_dtype(col)):
+                kind = 'int'
+            elif(pd.api.types.is_float_dtype(col)):
+                kind = 'float'
+            elif(col.dropna().map(type).eq(bool).all()):
+                # True/False with missing values
+                kind = 'bool'
+            else:
+                kind = 'str'
+            prev = kinds.get(name)
+            if(prev is None or prev == kind):
+                kinds[name] = kind
+            elif({prev, kind} == {'int', 'float'}):
+                kinds[name] = 'float'
+            else:
+                kinds[name] = 'str'
+    types = {'bool': 'boolean', 'float': 'float64', 'str': str, None: 'float64'}
+    return {name: ('float64' if name in has_missing else 'int64') if kind == 'int' else types[kind]
+            for name, kind in kinds.items()}
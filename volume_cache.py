@@ -0,0 +1,304 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import nibabel as nb
+import numpy as np
+import torch as T
+from torch.utils.data import get_worker_info
+from .loading import array_to_tensor, scale_tensor
+
+# File layout: MAGIC, header length (uint32, little-endian), JSON header, padding to DATA_ALIGN, data.
+# The array is stored in Fortran order (as in NIfTI), split into chunks along its last axis. Uncompressed data is a
+# single contiguous block and can be memory-mapped; compressed chunks are stored back to back.
+MAGIC = b'NDLVOL01'
+DATA_ALIGN = 64
+CACHE_SUFFIX = '.vol'
+
+
+def _get_codec(codec: str):
+    '''
+    Returns (compress, decompress) functions for codec.
+    '''
+    if(codec == 'zstd'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError('codec="zstd" requires the zstandard package')
+        return zstandard.ZstdCompressor(level=3).compress, zstandard.ZstdDecompressor().decompress
+    elif(codec == 'lz4'):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise ImportError('codec="lz4" requires the lz4 package')
+        return lz4.frame.compress, lz4.frame.decompress
+    else:
+        raise NotImplementedError(f'codec = {codec} has not been implemented')
+
+
+def write_volume(cache_file: str, arr: np.ndarray, slope: float = 1.0, inter: float = 0.0, codec: str = None,
+                 chunk_bytes: int = 1 << 22):
+    '''
+    Writes an array to a cache file. The file is replaced atomically.
+    Parameters
+    ----------
+    cache_file : str
+        Path of the file to write.
+    arr : np.ndarray
+        Unscaled image data.
+    slope : float
+        Optional. Intensity scaling slope, applied when reading.
+    inter : float
+        Optional. Intensity scaling intercept, applied when reading.
+    codec : str
+        Optional. Per-chunk compression codec: None (raw), 'zstd' or 'lz4'.
+    chunk_bytes : int
+        Optional. Approximate size of a chunk, before compression.
+    '''
+    arr = np.asfortranarray(arr)
+    arr = arr.astype(arr.dtype.newbyteorder('<'), copy=False)
+    # C-contiguous view with reversed axes: chunks along the first axis of `flat` are slabs along the last axis of arr
+    flat = arr.T if arr.ndim > 0 else arr.reshape(1)
+    slab_bytes = max(1, flat[0].nbytes) if flat.shape[0] > 0 else 1
+    chunk_len = max(1, chunk_bytes // slab_bytes)
+    chunks = [flat[i:i + chunk_len] for i in range(0, flat.shape[0], chunk_len)]
+    if(codec is not None):
+        compress, _ = _get_codec(codec)
+        payloads = [compress(c.tobytes()) for c in chunks]
+    else:
+        payloads = [c.tobytes() for c in chunks]
+    header = {'dtype': arr.dtype.str, 'shape': list(arr.shape), 'slope': float(slope), 'inter': float(inter),
+              'codec': codec, 'chunk_len': int(chunk_len), 'chunk_sizes': [len(p) for p in payloads]}
+    header_bytes = json.dumps(header).encode()
+    data_offset = len(MAGIC) + 4 + len(header_bytes)
+    padding = (-data_offset) % DATA_ALIGN
+
+    # Unique per thread: several threads of a process may write the same entry (e.g. prefetch.ReadAhead)
+    tmp_file = f'{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<I', len(header_bytes)))
+        f.write(header_bytes)
+        f.write(b'\0' * padding)
+        for p in payloads:
+            f.write(p)
+    os.replace(tmp_file, cache_file)
+
+
+def read_header(cache_file: str) -> dict:
+    '''
+    Reads the header of a cache file. The returned dict also holds 'data_offset', the position of the first chunk.
+    '''
+    with open(cache_file, 'rb') as f:
+        if(f.read(len(MAGIC)) != MAGIC):
+            raise ValueError(f'{cache_file} is not a volume cache file')
+        header_len = struct.unpack('<I', f.read(4))[0]
+        header = json.loads(f.read(header_len))
+    data_offset = len(MAGIC) + 4 + header_len
+    header['data_offset'] = data_offset + (-data_offset) % DATA_ALIGN
+    return header
+
+
+def read_volume(cache_file: str, last_axis: slice = None):
+    '''
+    Reads unscaled data from a cache file.
+    Parameters
+    ----------
+    cache_file : str
+        Path of the file.
+    last_axis : slice
+        Optional. Range along the last axis to read (step 1). For compressed files, only the chunks that overlap it are
+        decompressed. Defaults to the whole array.
+    Returns
+    -------
+    np.ndarray
+        Unscaled data (memory-mapped for uncompressed files), in Fortran order.
+    dict
+        Header, with 'slope' and 'inter'.
+    '''
+    header = read_header(cache_file)
+    shape = tuple(header['shape'])
+    dtype = np.dtype(header['dtype'])
+    n_last = shape[-1] if len(shape) > 0 else 1
+    start, stop, _ = (last_axis if last_axis is not None else slice(None)).indices(n_last)
+    stop = max(start, stop)
+    rev_shape = shape[::-1] if len(shape) > 0 else (1,)
+
+    if(header['codec'] is None):
+        flat = np.memmap(cache_file, dtype=dtype, mode='c', offset=header['data_offset'], shape=rev_shape)
+        flat = flat[start:stop]
+    else:
+        _, decompress = _get_codec(header['codec'])
+        chunk_len = header['chunk_len']
+        first_chunk = start // chunk_len
+        last_chunk = max(first_chunk, (stop - 1) // chunk_len)
+        offsets = np.concatenate([[0], np.cumsum(header['chunk_sizes'])]) + header['data_offset']
+        parts = []
+        with open(cache_file, 'rb') as f:
+            for c in range(first_chunk, min(last_chunk + 1, len(header['chunk_sizes']))):
+                f.seek(offsets[c])
+                buf = decompress(f.read(header['chunk_sizes'][c]))
+                parts.append(np.frombuffer(buf, dtype=dtype).reshape(-1, *rev_shape[1:]))
+        flat = np.concatenate(parts) if len(parts) > 1 else parts[0].copy()
+        flat = flat[start - first_chunk * chunk_len:stop - first_chunk * chunk_len]
+    arr = flat.T if len(shape) > 0 else flat.reshape(())
+    return arr, header
+
+
+class VolumeCache:
+    def __init__(self, cache_dir: str, max_bytes: int = None, codec: str = None, chunk_bytes: int = 1 << 22):
+        '''
+        Convert-once cache of image data. The first time an image is loaded, it is decoded and written to cache_dir in
+        a raw, chunked format (see write_volume); later loads read that file instead, memory-mapping it if it is
+        uncompressed. Entries are keyed by source path, mtime and size, so modified images are transcoded again.
+        Safe to share between processes (e.g. DataLoader workers): files are written atomically, and the size limit
+        accounts for the writes of every process.
+        Parameters
+        ----------
+        cache_dir : str
+            Directory holding the cache files. Created if it does not exist.
+        max_bytes : int
+            Optional. Size limit of the cache directory. When exceeded, least recently used entries are deleted.
+            Defaults to no limit. The limit holds across processes: each process measures the directory again once
+            its own writes exceed its share of the free space (divided between DataLoader workers), so the cache can
+            only overshoot by about one entry per worker.
+        codec : str
+            Optional. Per-chunk compression: None (raw, memory-mappable), 'zstd' (requires zstandard) or 'lz4'
+            (requires lz4).
+        chunk_bytes : int
+            Optional. Approximate uncompressed size of a chunk.
+        '''
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.codec = codec
+        self.chunk_bytes = chunk_bytes
+        if(codec is not None):
+            _get_codec(codec)
+        os.makedirs(cache_dir, exist_ok=True)
+        # Directory size at the last measurement, and bytes written by this process since then
+        self._total_bytes = None
+        self._written_bytes = 0
+
+    def cache_file(self, path: str) -> str:
+        '''
+        Returns the cache file corresponding to the current version of the image at path.
+        '''
+        st = os.stat(path)
+        key = f'{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}'
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode()).hexdigest() + CACHE_SUFFIX)
+
+    def read(self, path: str, last_axis: slice = None):
+        '''
+        Returns the unscaled data and header of the image at path, transcoding it first if it is not cached.
+        Parameters
+        ----------
+        path : str
+            Path of the source image.
+        last_axis : slice
+            Optional. Range along the last axis to read; see read_volume.
+        Returns
+        -------
+        np.ndarray
+            Unscaled data.
+        dict
+            Header, with 'slope' and 'inter'.
+        '''
+        cache_file = self.cache_file(path)
+        try:
+            arr, header = read_volume(cache_file, last_axis=last_axis)
+            # Access time for LRU eviction; atime is unreliable (noatime mounts), so use mtime
+            os.utime(cache_file)
+            return arr, header
+        except FileNotFoundError:
+            pass
+        proxy = nb.load(path).dataobj
+        arr = np.asanyarray(proxy.get_unscaled())
+        write_volume(cache_file, arr, slope=proxy.slope, inter=proxy.inter, codec=self.codec,
+                     chunk_bytes=self.chunk_bytes)
+        self._account(os.path.getsize(cache_file))
+        header = {'slope': float(proxy.slope), 'inter': float(proxy.inter), 'shape': list(arr.shape)}
+        if(last_axis is not None):
+            arr = arr[..., last_axis]
+        return arr, header
+
+    def load(self, path: str, dtype: T.dtype = None) -> T.Tensor:
+        '''
+        Loads the image at path through the cache. Data keeps its on-disk dtype; scaling is applied only if defined
+        (see loading.load_volume with memmap=True).
+        Parameters
+        ----------
+        path : str
+            Path of the source image.
+        dtype : torch.dtype
+            Optional. Output type; see loading.scale_tensor.
+        Returns
+        -------
+        Tensor
+            Image data.
+        '''
+        arr, header = self.read(path)
+        return scale_tensor(array_to_tensor(arr), header['slope'], header['inter'], dtype=dtype)
+
+    def _account(self, n_bytes: int):
+        '''
+        Records a write of n_bytes. Once this process' writes since the last measurement exceed its share of the free
+        space (other processes write to the directory too), the directory is measured again, and entries are evicted if
+        the limit is exceeded.
+        '''
+        if(self.max_bytes is None):
+            return
+        self._written_bytes += n_bytes
+        if(self._total_bytes is not None):
+            worker_info = get_worker_info()
+            n_writers = worker_info.num_workers if worker_info is not None else 1
+            if(self._written_bytes <= max(self.max_bytes - self._total_bytes, 0) / n_writers):
+                return
+        self._total_bytes = sum(e[1] for e in self._entries())
+        self._written_bytes = 0
+        if(self._total_bytes > self.max_bytes):
+            self.evict()
+
+    def _entries(self) -> list:
+        '''
+        Returns (path, size, last access) of every cache file.
+        '''
+        entries = []
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                if(entry.name.endswith(CACHE_SUFFIX)):
+                    try:
+                        st = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((entry.path, st.st_size, st.st_mtime_ns))
+        return entries
+
+    def evict(self, max_bytes: int = None):
+        '''
+        Deletes least recently used entries until the cache is at most max_bytes.
+        Parameters
+        ----------
+        max_bytes : int
+            Optional. Target size. Defaults to the cache limit.
+        '''
+        if(max_bytes is None):
+            max_bytes = self.max_bytes
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        total = sum(e[1] for e in entries)
+        for cache_file, size, _ in entries:
+            if(total <= max_bytes):
+                break
+            try:
+                os.remove(cache_file)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._total_bytes = total
+        self._written_bytes = 0
+
+    def clear(self):
+        '''
+        Deletes every entry.
+        '''
+        self.evict(max_bytes=0)